@@ -0,0 +1,129 @@
+import argparse, json, pathlib, statistics, sys, tempfile, time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from sfmlog import SFMlog, _stats
+
+# Each workload takes a scale and a directory to write extra files into, and returns (source code, as_text)
+
+def deep_macros(scale: int, directory: pathlib.Path) -> tuple[str, bool]:
+    code = "defmac M0 out\n  set out 0\nend\n"
+    for depth in range(1, scale + 1):
+        code += f"defmac M{depth} out\n  mac M{depth - 1} out\n  pop add out out 1\nend\n"
+    for _ in range(scale):
+        code += f"mac M{scale} r\nprint r\n"
+    return code, True
+
+def many_procs(scale: int, directory: pathlib.Path) -> tuple[str, bool]:
+    code = "pset $PROCESSOR_TYPE @logic-processor\nblock cell @memory-cell\n"
+    code += "defmac Store value\n  write value cell 0\nend\n"
+    for index in range(scale * 4):
+        code += f"proc\n  mac Store {index}\n  read x cell 0\n  print x\n  printflush message1\nend\n"
+    return code, False
+
+def compile_loops(scale: int, directory: pathlib.Path) -> tuple[str, bool]:
+    code = "set total 0\n"
+    code += f"for range i {scale * 50}\n  pop add total total i\n  pop mul sq i i\n  if equal sq 4\n    print i\n  end\nend\n"
+    code += "print total\n"
+    return code, True
+
+def collections(scale: int, directory: pathlib.Path) -> tuple[str, bool]:
+    code = "list from l\ntable from t\n"
+    code += f"for range i {scale * 50}\n  list append l i\n  table set t i i\nend\n"
+    code += f"for range i {scale * 10}\n  list in hit l i\n  list index idx l i\n  table get v t i\nend\n"
+    code += "list len n l\nprint n\n"
+    return code, True
+
+def import_fanout(scale: int, directory: pathlib.Path) -> tuple[str, bool]:
+    code = ""
+    for index in range(scale * 4):
+        lib = directory / f"lib{index}.sfmlib"
+        lib.write_text(f"defmac Lib{index} out\n  set out {index}\nend\n")
+        code += f"import \"{lib.name}\"\n"
+    for index in range(scale * 4):
+        code += f"mac Lib{index} r\nprint r\n"
+    return code, True
+
+def raw_mlog(scale: int, directory: pathlib.Path) -> tuple[str, bool]:
+    code = ""
+    for index in range(scale * 40):
+        code += f"op add x{index % 16} x{index % 16} {index}\nprint x{index % 16}\n"
+    code += "printflush message1\n"
+    return code, True
+
+WORKLOADS = {
+    "deep_macros": deep_macros,
+    "many_procs": many_procs,
+    "compile_loops": compile_loops,
+    "collections": collections,
+    "import_fanout": import_fanout,
+    "raw_mlog": raw_mlog
+}
+
+def run_workload(name: str, scale: int, repeat: int) -> dict:
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        directory = pathlib.Path(directory)
+        code, as_text = WORKLOADS[name](scale, directory)
+        source = directory / f"{name}.sfm"
+        source.write_text(code)
+        for _ in range(repeat):
+            stats = _stats()
+            start_time = time.perf_counter()
+            SFMlog().transpile(code, source, as_text, stats=stats)
+            total = time.perf_counter() - start_time
+            runs.append((total, stats))
+    best_total, best_stats = min(runs, key=lambda run: run[0])
+    result = best_stats.to_dict()
+    result["total"] = best_total
+    result["median_total"] = statistics.median(run[0] for run in runs)
+    result["scale"] = scale
+    result["source_lines"] = code.count("\n")
+    return result
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if old["scale"] != result["scale"]:
+            continue
+        checks = [("total", old["total"], result["total"])]
+        for phase, times in result["phases"].items():
+            if phase in old["phases"]:
+                checks.append((phase, old["phases"][phase]["wall"], times["wall"]))
+        for label, old_time, new_time in checks:
+            if old_time > 0.005 and new_time > old_time * (1 + threshold):
+                regressions.append(f"{name} {label}: {old_time * 1000:.2f} ms -> {new_time * 1000:.2f} ms (+{(new_time / old_time - 1) * 100:.0f}%)")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='bench', description='Times each stage of sfmlog on synthetic sources')
+    parser.add_argument('-w', '--workload', action='append', choices=list(WORKLOADS), help="the workloads to run, all of them by default")
+    parser.add_argument('--scale', type=int, default=10, help="how large the generated sources are")
+    parser.add_argument('--repeat', type=int, default=5, help="how many times each workload is run, the fastest run is kept")
+    parser.add_argument('-o', '--out', type=pathlib.Path, help="the file to write the results to as json", metavar="results_file")
+    parser.add_argument('--compare', type=pathlib.Path, help="a previous results file to check for regressions against", metavar="baseline_file")
+    parser.add_argument('--threshold', type=float, default=0.15, help="the fraction a stage may slow down by before it counts as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.workload or WORKLOADS:
+        result = run_workload(name, args.scale, args.repeat)
+        results[name] = result
+        phases = ", ".join(f"{phase} {times['wall'] * 1000:.2f}" for phase, times in result["phases"].items() if times["wall"] > 0)
+        print(f"{name:<14} {result['total'] * 1000:>9.2f} ms  ({phases})")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
@@ -14,6 +14,34 @@ import time
 import dill
 import json
 import io
+import mmap
+import array
+import functools
+import itertools
+import os
+import hashlib
+import collections
+import marshal
+import tempfile
+import contextlib
+import urllib.parse
+import urllib.request
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+try:
+    import numpy
+except ImportError: # Optional, lop falls back to packed arrays
+    numpy = None
+
+class _CompileError(SystemExit): # Raised for errors in the compiled code, exits with code 2 unless it is caught
+    def __init__(self, message: str, line: int | None = None, column: int | None = None, file: pathlib.Path | None = None):
+        super().__init__(2)
+        self.message = message
+        self.line = line
+        self.column = column
+        self.file = file
 
 def _error(text: str, token, executer):
     print(f"Error: {text}\nTraceback (most recent call last):")
@@ -26,19 +54,20 @@ def _error(text: str, token, executer):
         print(f"({token.line},{token.column})")
     else:
         print(f"({token.line},{token.column}) in '{token.file.resolve()}'")
-    sys.exit(2)
+    raise _CompileError(text, token.line, token.column, token.file)
 
 def _warning(text: str, token, executer):
-    print(f"Warning: {text}\nTraceback (most recent call last):")
+    lines = [f"Warning: {text}\nTraceback (most recent call last):"]
     for cause in (executer.owners + [executer.spawn_instruction])[1:]:
         if cause[0].file is None:
-            print(f"({cause[0].line},{cause[0].column})")
+            lines.append(f"({cause[0].line},{cause[0].column})")
         else:
-            print(f"({cause[0].line},{cause[0].column}) in '{cause[0].file.resolve()}'")
+            lines.append(f"({cause[0].line},{cause[0].column}) in '{cause[0].file.resolve()}'")
     if token.file is None:
-        print(f"({token.line},{token.column})")
+        lines.append(f"({token.line},{token.column})")
     else:
-        print(f"({token.line},{token.column}) in '{token.file.resolve()}'")
+        lines.append(f"({token.line},{token.column}) in '{token.file.resolve()}'")
+    executer.context.message("\n".join(lines))
 
 class _Color:
     def __init__(self, r: int, g: int, b: int, a: int):
@@ -65,11 +94,12 @@ class _Color:
         return f"%{self.to_hex()}"
 
 class _Macro:
-    def __init__(self, name, code, args, cwd):
+    def __init__(self, name, code, args, cwd, pure=False):
         self.name: str = name
         self.code: list[_tokenizer.token] = code
         self.args: list[_tokenizer.token] = args
         self.cwd: pathlib.Path = cwd
+        self.pure: bool = pure
 
     def __str__(self):
         return f"macro({self.name})"
@@ -84,25 +114,625 @@ class _Function:
     def __str__(self):
         return f"function({self.name})"
 
+class _StringBuilder:
+    # Collects the pieces of a string so that building it up costs one join instead of a copy per piece
+    def __init__(self):
+        self.parts: list[str] = []
+
+    def append(self, text: str):
+        self.parts.append(text)
+
+    def text(self) -> str:
+        if len(self.parts) > 1:
+            self.parts[:] = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def copy(self) -> "_StringBuilder":
+        builder = _StringBuilder()
+        builder.append(self.text())
+        return builder
+
+    def __str__(self):
+        return self.text()
+
+@functools.lru_cache(maxsize=512)
+def _compile_regex(pattern: str) -> re.Pattern:
+    return re.compile(pattern)
+
+class _BinFile:
+    # A binary file read through a memory map, so seeking and bulk reads don't go through a buffered reader
+    def __init__(self, path: pathlib.Path):
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # Empty files can't be mapped
+            self.data = io.BytesIO(b"")
+
+    def read(self, count: int = -1) -> bytes:
+        return self.data.read(count)
+
+    def seek(self, pos: int, whence: int = 0):
+        self.data.seek(pos, whence)
+
+    def tell(self) -> int:
+        return self.data.tell()
+
+    def size(self) -> int:
+        return len(self.data) if isinstance(self.data, mmap.mmap) else 0
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+class _TokenList(list):
+    # A list of tokens that lazily builds a hash index from (type, value) to the first matching position
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._index: dict[tuple, int] | None = None
+
+    def find(self, token) -> int:
+        key = (token.type, token.value)
+        try:
+            hash(key)
+        except TypeError:
+            for index, elem in enumerate(self):
+                if elem.type == token.type and elem.value == token.value:
+                    return index
+            return -1
+        if self._index is None:
+            self._index = {}
+            for index, elem in enumerate(self):
+                try:
+                    self._index.setdefault((elem.type, elem.value), index)
+                except TypeError:
+                    pass
+        return self._index.get(key, -1)
+
+    def append(self, value):
+        super().append(value)
+        if self._index is not None:
+            try:
+                self._index.setdefault((value.type, value.value), len(self) - 1)
+            except TypeError:
+                pass
+
+    def _invalidate(self):
+        self._index = None
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._invalidate()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._invalidate()
+
+    def __iadd__(self, other):
+        self._invalidate()
+        return super().__iadd__(other)
+
+    def insert(self, index, value):
+        super().insert(index, value)
+        self._invalidate()
+
+    def pop(self, index=-1):
+        self._invalidate()
+        return super().pop(index)
+
+    def remove(self, value):
+        super().remove(value)
+        self._invalidate()
+
+    def extend(self, values):
+        super().extend(values)
+        self._invalidate()
+
+    def clear(self):
+        super().clear()
+        self._invalidate()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._invalidate()
+
+    def reverse(self):
+        super().reverse()
+        self._invalidate()
+
+class _vector:
+    # Elementwise math for lop and the list reductions, run over packed float arrays instead of one token at a time
+    NUMPY_THRESHOLD = 64 # Below this converting to a numpy array costs more than it saves
+
+    # Only operations numpy rounds exactly like Python, so output doesn't depend on whether it is installed, with their ufunc and operand count
+    NUMPY = {
+        "add": ("add", 2),
+        "sub": ("subtract", 2),
+        "mul": ("multiply", 2),
+        "equal": ("equal", 2),
+        "notEqual": ("not_equal", 2),
+        "lessThan": ("less", 2),
+        "lessThanEq": ("less_equal", 2),
+        "greaterThan": ("greater", 2),
+        "greaterThanEq": ("greater_equal", 2),
+        "strictEqual": ("equal", 2),
+        "abs": ("absolute", 1),
+        "floor": ("floor", 1),
+        "ceil": ("ceil", 1)
+    }
+
+    def pack(lst: list) -> array.array | None: # Returns the values of a list of numbers as doubles, or None if any item isn't a number
+        values = array.array("d")
+        for item in lst:
+            if item.type != "number":
+                return None
+            values.append(item.value)
+        return values
+
+    def apply(operation: str, a: array.array | float, b: array.array | float, length: int) -> list[float] | None: # Returns None if the operation has no numeric fast path
+        if operation not in _executer.MATH_OPERATIONS:
+            return None
+        if numpy is not None and operation in _vector.NUMPY and length >= _vector.NUMPY_THRESHOLD:
+            ufunc, count = _vector.NUMPY[operation]
+            operands = [numpy.frombuffer(x) if isinstance(x, array.array) else x for x in (a, b)[:count]]
+            if all(numpy.isfinite(x).all() for x in operands): # Python raises on some non-finite input where numpy doesn't, so those take the plain path
+                out = getattr(numpy, ufunc)(*operands)
+                return numpy.broadcast_to(out, (length,)).astype(float).tolist()
+        func = _executer.MATH_OPERATIONS[operation]
+        a = a if isinstance(a, array.array) else itertools.repeat(a, length)
+        b = b if isinstance(b, array.array) else itertools.repeat(b, length)
+        return [float(func(x, y)) for x, y in zip(a, b)]
+
+def _overlay(table: dict | collections.ChainMap) -> collections.ChainMap: # Copy-on-write view of a scope table, writes only go to the new top layer
+    if isinstance(table, collections.ChainMap):
+        return collections.ChainMap({}, *(layer for layer in table.maps if layer))
+    return collections.ChainMap({}, table)
+
+def _token_sig(token) -> tuple:
+    if token.type == "list":
+        return ("list", tuple(_token_sig(x) for x in token.value))
+    elif token.type == "table":
+        return ("table", tuple((k, _token_sig(v)) for k, v in token.value.items()))
+    elif token.type == "color":
+        return ("color", token.value.to_hex())
+    elif token.type == "builder":
+        return ("builder", token.value.text())
+    elif token.type in ["identifier", "label"]:
+        return (token.type, token.value, token.scope)
+    else:
+        return (token.type, token.value)
+
+def _sort_key(token) -> tuple: # Orders null, then numbers, then strings, then content, then anything else grouped by type
+    match token.type:
+        case "null":
+            return (0,)
+        case "number":
+            return (1, token.value)
+        case "string":
+            return (2, token.value[1:-1])
+        case "content":
+            return (3, token.value)
+        case "list":
+            return (4, "list", tuple(_sort_key(x) for x in token.value))
+        case "table":
+            return (4, "table", len(token.value))
+        case "color":
+            return (4, "color", token.value.to_hex())
+        case _:
+            return (4, token.type, str(token.value))
+
+class _Trace:
+    # Records what a piece of code reads from and writes to the executer state around it, so that
+    # its result can be replayed later as long as everything it read is still the same
+    def __init__(self, executer, track_vars=True, track_macros=True):
+        self.tables: dict[str, dict] = {
+            "var": executer.vars if track_vars else None,
+            "global": executer.global_vars,
+            "mac": executer.macros if track_macros else None,
+            "fun": executer.functions
+        }
+        self.aliases: dict[int, dict] = {}
+        self.reads: dict[tuple[str, str | tuple[str, str]], any] = {} # (kind, key), var keys are (scope, name)
+        self.writes: dict[tuple[str, str | tuple[str, str]], _tokenizer.token] = {}
+        self.written: set[tuple[str, str | tuple[str, str]]] = set()
+        self.impure = False
+        self.files: set[pathlib.Path] = set() # Files imported while tracing, their contents only stay the same within one build
+        self.start_run_counts: dict[str, int] = executer.macro_run_counts.copy()
+        self.run_counts: list[tuple[str, int, int]] = []
+        self.called: list[str] = []
+        self.calls: list[tuple[str, _tokenizer.token]] = [] # Every function call made, for the call graph
+        self.output: list[_tokenizer.token] = []
+        self.values: list[_tokenizer.token] = []
+
+    def tracks(self, kind: str, table: dict) -> bool:
+        return table is self.tables[kind] or id(table) in self.aliases
+
+    def alias(self, kind: str, table: dict, source: dict):
+        if self.tracks(kind, source):
+            self.aliases[id(table)] = table
+
+    def read(self, kind: str, table: dict, key):
+        if (kind, key) in self.reads or (kind, key) in self.written or not self.tracks(kind, table):
+            return
+        value = table.get(key)
+        if kind in ["var", "global"] and value is not None:
+            value = _token_sig(value)
+        self.reads[(kind, key)] = value
+
+    def write(self, kind: str, table: dict, key, value):
+        if table is self.tables[kind]:
+            self.writes[(kind, key)] = value
+            self.written.add((kind, key))
+        elif id(table) in self.aliases:
+            self.written.add((kind, key))
+
+    def finish(self, executer):
+        for name, count in executer.macro_run_counts.items():
+            start = self.start_run_counts.get(name, 0)
+            if count != start:
+                self.run_counts.append((name, start, count - start))
+        self.called = list(dict.fromkeys(name for name, _ in self.calls)) # Every callee, even ones already called before recording, since a replay may happen where they weren't
+        for (kind, key), value in self.writes.items(): # Snapshots lists, tables and builders, which the code after this can still change in place
+            if kind in ["var", "global"]:
+                self.writes[(kind, key)] = _Trace.rescope(value, {})
+
+    def scopes(self) -> list[str]:
+        return [f"m_{name}_{start + i}_" for name, start, count in self.run_counts for i in range(count)]
+
+    def leaks_scope(self) -> bool: # Checks if any produced scope was baked into a string, which can't be rewritten on replay
+        scopes = set(self.scopes())
+        if len(scopes) == 0:
+            return False
+        def check(token):
+            if token.type == "list":
+                return any(check(x) for x in token.value)
+            elif token.type == "table":
+                return any(check(x) for x in token.value.values())
+            elif isinstance(token.value, str) and "m_" in token.value:
+                return any(scope in token.value for scope in scopes)
+            return False
+        return any(check(x) for x in self.output) or any(check(x) for x in self.values) or any(check(x) for x in self.writes.values())
+
+    def rescope(token, scope_map: dict[str, str]):
+        if token.type == "list":
+            value = _TokenList(_Trace.rescope(x, scope_map) for x in token.value)
+        elif token.type == "table":
+            value = {k: _Trace.rescope(v, scope_map) for k, v in token.value.items()}
+        elif token.type == "builder": # Copied so appends after a replay don't change the recorded value
+            value = token.value.copy()
+        elif token.scope in scope_map:
+            value = token.value
+        else:
+            return token
+        return _tokenizer.token(token.type, value, token.line, token.column, token.file, scope=scope_map.get(token.scope, token.scope), exportable=token.exportable)
+
+class _limits: # Budgets for compile time execution, None means unlimited
+    def __init__(self, max_steps: int | None = None, max_depth: int | None = None, max_time: float | None = None, max_collection: int | None = None):
+        self.max_steps = max_steps
+        self.max_depth = max_depth
+        self.max_time = max_time # Seconds
+        self.max_collection = max_collection
+        self.active = max_steps is not None or max_time is not None
+        self.steps = 0
+        self.deadline: float | None = None
+
+    def step(self, token: _tokenizer.token, executer):
+        self.steps += 1
+        if self.max_steps is not None and self.steps > self.max_steps:
+            _error(f"Build exceeded the limit of {self.max_steps} executed instructions", token, executer)
+        if self.max_time is not None and self.steps % 64 == 1:
+            if self.deadline is None:
+                self.deadline = time.perf_counter() + self.max_time
+            elif time.perf_counter() > self.deadline:
+                _error(f"Build exceeded the time limit of {self.max_time:g} seconds", token, executer)
+
+    def check_depth(self, token: _tokenizer.token, executer): # Counts the macros and imports the executer is nested in
+        if self.max_depth is not None and len(executer.owners) > self.max_depth:
+            _error(f"Macros and imports nested deeper than the limit of {self.max_depth}", token, executer)
+
+    def check_collection(self, name: _tokenizer.token, value: _tokenizer.token, executer):
+        if self.max_collection is not None and value.type in ["list", "table"] and len(value.value) > self.max_collection:
+            _error(f"'{name.value}' has {len(value.value)} items, over the limit of {self.max_collection}", name, executer)
+
+class _BuildContext: # Holds the compile time sources of randomness and time, so a build can be reproduced
+    def __init__(self, seed: int | None = None, clock: float | None = None, limits: _limits | None = None):
+        self.seed = seed
+        self.limits = limits if limits is not None else _limits()
+        self.random = random.Random(seed)
+        self.clock = clock # Frozen time in milliseconds, or None to use the real clock
+        self.nondeterministic = False # Set once the build has used randomness or time that isn't fixed
+        self.inputs: set[pathlib.Path] = set() # Every file the build read
+        self.messages: list[str] = [] # Everything the build printed, so a cached build can print it again
+
+    def record_input(self, path: pathlib.Path):
+        self.inputs.add(path.resolve())
+
+    def message(self, text: str):
+        self.messages.append(text)
+        print(text)
+
+    def from_env(seed: int | None = None, clock: float | None = None, limits: _limits | None = None) -> "_BuildContext":
+        if clock is None and "SOURCE_DATE_EPOCH" in os.environ:
+            clock = float(os.environ["SOURCE_DATE_EPOCH"]) * 1000
+        return _BuildContext(seed, clock, limits)
+
+    def rand(self, limit: float) -> float:
+        if self.seed is None:
+            self.nondeterministic = True
+        return self.random.uniform(0, limit)
+
+    def ctime(self) -> float:
+        if self.clock is None:
+            self.nondeterministic = True
+            return float(time.time()*1000)
+        return self.clock
+
+    def ptime(self) -> float:
+        if self.clock is None:
+            self.nondeterministic = True
+            return float(time.process_time()*1000)
+        return 0.0
+
+class _OutputCache: # Stores finished builds on disk, keyed on everything that can change their output
+    VERSION: str | None = None
+
+    def __init__(self, directory: pathlib.Path, max_entries: int = 256):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.stats_file = self.directory / "stats.json"
+        try:
+            with open(self.stats_file, "r") as f:
+                self.stats = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.stats = {"hits": 0, "misses": 0, "skipped": 0, "evictions": 0}
+        self.last_result = None
+
+    def version() -> str: # Changes whenever the transpiler itself changes, hashed once per run
+        if _OutputCache.VERSION is None:
+            _OutputCache.VERSION = hashlib.sha256(pathlib.Path(__file__).read_bytes()).hexdigest()
+        return _OutputCache.VERSION
+
+    def hash_file(path: pathlib.Path) -> str | None:
+        try:
+            with open(path, "rb") as f:
+                return hashlib.file_digest(f, "sha256").hexdigest()
+        except OSError:
+            return None
+
+    def key(self, code: str, file: pathlib.Path, as_text: bool, context: _BuildContext) -> str:
+        limits = context.limits
+        flags = json.dumps([str(file.resolve()), as_text, context.seed, context.clock, limits.max_steps, limits.max_depth, limits.max_time, limits.max_collection])
+        return hashlib.sha256("\0".join([_OutputCache.version(), flags, code]).encode()).hexdigest()
+
+    def load(self, key: str) -> tuple[bytes, list[str]] | None:
+        manifest_file = self.directory / f"{key}.json"
+        try:
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+            for path, digest in manifest["inputs"].items():
+                if _OutputCache.hash_file(pathlib.Path(path)) != digest:
+                    return None
+            with open(self.directory / f"{key}.out", "rb") as f:
+                data = f.read()
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+        os.utime(manifest_file) # Marks the entry as recently used
+        return data, manifest["messages"]
+
+    def store(self, key: str, data: bytes, context: _BuildContext):
+        manifest = {
+            "inputs": {str(path): _OutputCache.hash_file(path) for path in sorted(context.inputs)},
+            "messages": context.messages
+        }
+        self.write_atomic(self.directory / f"{key}.out", data)
+        self.write_atomic(self.directory / f"{key}.json", json.dumps(manifest).encode())
+        self.evict(self.directory, self.max_entries)
+
+    def value_sig(value) -> str: # Turns a value read by a trace into a digest that is the same across runs
+        if isinstance(value, _Macro):
+            value = ("mac", value.name, [_token_sig(arg) for arg in value.args], [_token_sig(token) for token in value.code], str(value.cwd), value.pure)
+        elif isinstance(value, _Function):
+            value = ("fun", value.name, [(_token_sig(arg), direction) for arg, direction in value.args], [_token_sig(token) for token in value.code], str(value.cwd))
+        elif isinstance(value, _tokenizer.token):
+            value = _token_sig(value)
+        return hashlib.sha256(repr(value).encode()).hexdigest()
+
+    def proc_key(self, code: list[_tokenizer.token], cwd: pathlib.Path) -> str:
+        return hashlib.sha256("\0".join([_OutputCache.version(), str(cwd), repr([_token_sig(token) for token in code])]).encode()).hexdigest()
+
+    def load_proc(self, key: str, executer) -> tuple[str, int] | None: # Returns the code and instruction count of a proc if nothing it read has changed
+        entry_file = self.directory / "procs" / f"{key}.json"
+        try:
+            with open(entry_file, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        tables = executer.trace_tables()
+        for kind, name, digest in entry["reads"]:
+            if kind == "var":
+                name = tuple(name) # Stored as a json list
+            if _OutputCache.value_sig(tables[kind].get(name)) != digest:
+                return None
+        os.utime(entry_file)
+        return entry["code"], entry["instructions"]
+
+    def store_proc(self, key: str, trace: _Trace, code: str, instructions: int):
+        entry = {
+            "reads": [[kind, name, _OutputCache.value_sig(value)] for (kind, name), value in trace.reads.items()],
+            "code": code,
+            "instructions": instructions
+        }
+        (self.directory / "procs").mkdir(exist_ok=True)
+        self.write_atomic(self.directory / "procs" / f"{key}.json", json.dumps(entry).encode())
+        self.evict(self.directory / "procs", self.max_entries * 16)
+
+    def evict(self, directory: pathlib.Path, max_entries: int): # Removes the least recently used entries once there are too many
+        manifests = sorted(directory.glob("*.json"), key=lambda path: path.stat().st_mtime)
+        manifests = [path for path in manifests if path != self.stats_file]
+        for manifest_file in manifests[:max(0, len(manifests) - max_entries)]:
+            manifest_file.unlink(missing_ok=True)
+            manifest_file.with_suffix(".out").unlink(missing_ok=True)
+            self.stats["evictions"] += 1
+
+    def write_atomic(self, path: pathlib.Path, data: bytes):
+        temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def record(self, result: str):
+        self.last_result = {"hits": "hit", "misses": "miss", "skipped": "skipped"}[result]
+        self.stats[result] += 1
+        self.write_atomic(self.stats_file, json.dumps(self.stats).encode())
+
+    def report(self) -> str:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        ratio = self.stats["hits"] / lookups * 100 if lookups > 0 else 0
+        return f"Cache {self.last_result}, {self.stats['hits']} hits / {lookups} lookups ({ratio:.0f}%), {self.stats['skipped']} uncacheable builds, {self.stats['evictions']} evictions"
+
 class SFMlog:
     def __init__(self):
         pass
 
-    def transpile(self, code: str, file: pathlib.Path, as_text) -> pymsch.Schematic|str:
-        tokenizer = _tokenizer(code, file)
+    def transpile(self, code: str, file: pathlib.Path, as_text, profiler: _profiler | None = None, stats: _stats | None = None, context: _BuildContext | None = None, cache: _OutputCache | None = None, tokens: list[_tokenizer.token] | None = None, stream: io.TextIOBase | None = None, proc_dir: pathlib.Path | None = None) -> pymsch.Schematic|str|None:
+        # Text output is written to stream instead of being returned when one is given, and each proc's code is written to proc_dir when building a schematic
+        if cache is not None and proc_dir is None: # A cached schematic has no proc names to write files for, so those builds only reuse cached procs
+            if context is None:
+                context = _BuildContext()
+            cache_key = cache.key(code, file, as_text, context)
+            cached = cache.load(cache_key)
+            if cached is not None:
+                data, messages = cached
+                for message in messages:
+                    print(message)
+                cache.record("hits")
+                if stats is not None:
+                    stats.finish()
+                if as_text and stream is not None:
+                    stream.write(data.decode())
+                    return None
+                return data.decode() if as_text else pymsch.Schematic.read_str(data.decode())
+            out = self._build(code, file, as_text, profiler, stats, context, cache, tokens, None, None)
+            if context.nondeterministic: # Builds that used the real clock or unseeded randomness can't be reproduced
+                cache.record("skipped")
+            else:
+                cache.store(cache_key, (out if as_text else out.write_str()).encode(), context)
+                cache.record("misses")
+            if as_text and stream is not None:
+                stream.write(out)
+                return None
+            return out
+        return self._build(code, file, as_text, profiler, stats, context, cache, tokens, stream, proc_dir)
+
+    def session(self, file: pathlib.Path, as_text: bool = True, seed: int | None = 0) -> _session: # Starts an incremental build of one file, for editors
+        return _session(file, as_text, seed)
+
+    def _build(self, code: str, file: pathlib.Path, as_text, profiler: _profiler | None, stats: _stats | None, context: _BuildContext | None, cache: _OutputCache | None, tokens: list[_tokenizer.token] | None, stream: io.TextIOBase | None, proc_dir: pathlib.Path | None) -> pymsch.Schematic|str|None:
+        if profiler is not None:
+            profiler.push(f"main {file.name}")
+        if stats is not None:
+            stats.start("tokenize")
+        if tokens is None:
+            tokens = _tokenizer(code, file).tokens
+        if stats is not None:
+            stats.stop("tokenize")
+            stats.source_tokens += len(tokens)
+            stats.executers += 1
+            stats.start("execute")
         schem_builder = _schem_builder()
-        executer = _executer(None, tokenizer.tokens)
+        executer = _executer(None, tokens)
         executer.as_text = as_text
         executer.cwd = file.parent
         executer.global_cwd = file.parent
         executer.schem_builder = schem_builder
+        executer.profiler = profiler
+        executer.stats = stats
+        executer.cache = cache
+        executer.context = context if context is not None else _BuildContext()
         executer.as_root_level()
-        executer.execute()
+        try:
+            executer.execute()
+        except RecursionError as error: # Reported once the stack has unwound, at the innermost macro or import it went through
+            inst, site = getattr(error, "sfmlog_site", (None, executer))
+            _error("Macros and imports nested too deeply", inst[0] if inst is not None else tokens[0], site)
+        finally: # Files opened at compile time are closed even when the build fails
+            for open_file in executer.open_files:
+                open_file.close()
+            executer.open_files.clear()
+        if stats is not None:
+            stats.stop("execute")
+        if profiler is not None:
+            profiler.pop(len(executer.output))
         if not as_text:
+            if stats is not None:
+                stats.start("make_schem")
             schem_builder.make_schem()
+            if proc_dir is not None:
+                schem_builder.write_procs(proc_dir)
+            if stats is not None:
+                stats.stop("make_schem")
+                stats.finish()
             return schem_builder.schem
         else:
-            return _tokenizer.token_list_to_str(executer.output)
+            if stats is not None:
+                stats.start("serialize")
+            if stream is not None:
+                _tokenizer.write_tokens(executer.output, stream)
+                out = None
+            else:
+                out = _tokenizer.token_list_to_str(executer.output)
+            if stats is not None:
+                stats.stop("serialize")
+                stats.finish()
+            return out
+
+class _session: # Keeps one file's tokens and compiled procs between edits, so each change only redoes what it affects
+    class Result:
+        def __init__(self, output: pymsch.Schematic | str | None, errors: list[_CompileError], messages: str):
+            self.output = output
+            self.errors = errors
+            self.messages = messages # Everything the build printed
+
+    MAX_STEPS = 5_000_000 # Builds run on every edit, so a loop typed halfway has to stop instead of hanging the editor
+    MAX_TIME = 5.0
+    MAX_DEPTH = 200
+
+    def __init__(self, file: pathlib.Path, as_text: bool, seed: int | None):
+        self.file = file
+        self.as_text = as_text
+        self.seed = seed
+        self.code = ""
+        self.tokenizer: _tokenizer | None = None
+        self.cache_dir = tempfile.TemporaryDirectory(prefix="sfmlog-session-")
+        self.cache = _OutputCache(pathlib.Path(self.cache_dir.name))
+
+    def update(self, code: str) -> Result:
+        messages = io.StringIO()
+        output = None
+        errors = []
+        with contextlib.redirect_stdout(messages):
+            try:
+                if self.tokenizer is None:
+                    self.tokenizer = _tokenizer(code, self.file)
+                else:
+                    self.tokenizer.update(code)
+                self.code = code
+                # A frozen clock keeps builds deterministic, so unchanged procs and whole builds can be reused
+                context = _BuildContext(self.seed, 0.0, _limits(max_steps=_session.MAX_STEPS, max_depth=_session.MAX_DEPTH, max_time=_session.MAX_TIME))
+                output = SFMlog().transpile(code, self.file, self.as_text, context=context, cache=self.cache, tokens=self.tokenizer.tokens)
+            except _CompileError as error:
+                errors.append(error)
+            except Exception as error: # A bug in the compiler must not take the editor's session down with it
+                errors.append(_CompileError(f"Internal error: {error!r}"))
+        return self.Result(output, errors, messages.getvalue())
+
+    def edit(self, start_line: int, end_line: int, text: str) -> Result: # Replaces lines start_line to end_line, 1 based and inclusive, with text
+        lines = self.code.split("\n")
+        lines[start_line - 1:end_line] = text.split("\n")
+        return self.update("\n".join(lines))
+
+    def close(self):
+        self.cache_dir.cleanup()
 
 class _tokenizer:
     SUB_INSTRUCTION_MAP = {
@@ -126,6 +756,7 @@ class _tokenizer:
         "setmarker": [True],
         "makemarker": [True],
         "pop": [True],
+        "lop": [True],
         "spop": [True],
         "if": [True],
         "while": [True],
@@ -180,41 +811,72 @@ class _tokenizer:
             else:
                 return self.value
 
-    def __init__(self, code: str, file: pathlib.Path):
-        self.tokens: list[_tokenizer.token] = self.tokenize(code, file)
+    LINE_START_STATE = ("line_break", "", 0) # Previous token type, previous instruction and distance from it
+    TOKEN_REGEX = re.compile(r"#.*|(\".*?\"|[^ \t\n;]+|[\n;])")
 
-    def tokenize(self, code: str, file: str) -> list[token]:
+    def __init__(self, code: str, file: pathlib.Path):
+        self.file = file
+        self.source_lines: list[str] = []
+        self.line_tokens: list[list[_tokenizer.token]] = []
+        self.line_states: list[tuple[str, str, int]] = [self.LINE_START_STATE] # State at the start of each line, and after the last one
+        self.tokens: list[_tokenizer.token] = self.update(code)
+
+    def update(self, code: str) -> list[token]: # Re-tokenizes only the lines that changed since the last call, tokens never span lines
+        new_lines = [line + "\n" for line in code.split("\n")]
+        new_lines[-1] = new_lines[-1][:-1]
+        old_lines = self.source_lines
+        start = 0
+        while start < min(len(old_lines), len(new_lines)) and old_lines[start] == new_lines[start]:
+            start += 1
+        old_end, new_end = len(old_lines), len(new_lines)
+        while old_end > start and new_end > start and old_lines[old_end - 1] == new_lines[new_end - 1]:
+            old_end -= 1
+            new_end -= 1
+        shift = new_end - old_end
+        line_tokens = self.line_tokens[:start]
+        line_states = self.line_states[:start + 1]
+        index = start
+        while index < len(new_lines):
+            old_index = index - shift
+            if index >= new_end and line_states[index] == self.line_states[old_index]: # The rest of the file is unchanged and starts in the same state
+                for tokens in self.line_tokens[old_index:]:
+                    for token in tokens:
+                        token.line += shift
+                    line_tokens.append(tokens)
+                line_states.extend(self.line_states[old_index + 1:])
+                break
+            tokens, state = self.tokenize_line(new_lines[index], index + 1, line_states[index])
+            line_tokens.append(tokens)
+            line_states.append(state)
+            index += 1
+        self.source_lines = new_lines
+        self.line_tokens = line_tokens
+        self.line_states = line_states
+        self.tokens = [token for tokens in line_tokens for token in tokens]
+        if len(self.tokens) > 0 and self.tokens[-1].type != "line_break":
+            self.tokens.append(self.token("line_break", "\n", self.tokens[-1].line, self.tokens[-1].column, self.file))
+        return self.tokens
+
+    def tokenize_line(self, text: str, line: int, state: tuple[str, str, int]) -> tuple[list[token], tuple[str, str, int]]:
         tokens = []
-        line_regex = r"^[^#\n].+$[\n;]?"
-        token_regex = r"#.*|(\".*?\"|[^ \t\n;]+|[\n;])"
-        prev_instruction = ""
-        prev_token_type = "line_break"
-        dist_from_prev_instruction = 0
-        for line_match in re.finditer(line_regex, code, flags=re.M):
-            for token_match in re.finditer(token_regex, line_match[0], flags=re.M):
-                match_string = token_match.groups()[0]
-                if match_string is not None:
-                    line = 0
-                    column = 0
-                    for index, value in enumerate(code):
-                        column += 1
-                        if index >= line_match.start() + token_match.start():
-                            break
-                        if value == "\n":
-                            line += 1
-                            column = 0
-
-                    token_type, token_value = self.identify_token(match_string, prev_token_type, prev_instruction, dist_from_prev_instruction, (line + 1, column))
-                    dist_from_prev_instruction += 1
-                    if token_type == "instruction":
-                        prev_instruction = match_string
-                        dist_from_prev_instruction = 0
-                    if not (token_type == "line_break" and prev_token_type == "line_break"):
-                        tokens.append(self.token(token_type, token_value, line + 1, column, file))
-                    prev_token_type = token_type
-        if tokens[-1].type != "line_break":
-            tokens.append(self.token("line_break", "\n", line + 1, column, file))
-        return tokens
+        if len(text.rstrip("\n")) < 2 or text[0] == "#":
+            return tokens, state
+        prev_token_type, prev_instruction, dist_from_prev_instruction = state
+        for token_match in self.TOKEN_REGEX.finditer(text):
+            match_string = token_match.group(1)
+            if match_string is not None:
+                column = token_match.start() + 1
+                token_type, token_value = self.identify_token(match_string, prev_token_type, prev_instruction, dist_from_prev_instruction, (line, column))
+                dist_from_prev_instruction += 1
+                if token_type == "instruction":
+                    prev_instruction = match_string
+                    dist_from_prev_instruction = 0
+                if token_type in ["identifier", "global_identifier", "expansion_identifier"]:
+                    token_value = sys.intern(token_value) # Names are mostly used as dict keys
+                if not (token_type == "line_break" and prev_token_type == "line_break"):
+                    tokens.append(self.token(token_type, token_value, line, column, self.file))
+                prev_token_type = token_type
+        return tokens, (prev_token_type, prev_instruction, dist_from_prev_instruction)
 
     def identify_token(self, string: str, prev_token_type: str, prev_instruction: str, dist_from_prev_instruction: int, pos: tuple[int, int]) -> tuple[str, str | float]:
         if string in "\n;":
@@ -228,14 +890,14 @@ class _tokenizer:
 
         if string[0] == '"' or string[-1] == '"':
             print(f"ERROR at ({pos[0]},{pos[1]}): String not closed")
-            sys.exit(2)
+            raise _CompileError("String not closed", pos[0], pos[1], self.file)
 
         if string[0] == '%':
             try:
                 return ("color", _Color.from_hex(string[1:]))
             except ValueError:
                 print(f"ERROR at ({pos[0]},{pos[1]}): Invalid color")
-                sys.exit(2)
+                raise _CompileError("Invalid color", pos[0], pos[1], self.file)
 
         if re.search(r"^0x[0-9a-fA-F]*$", string):
             return ("number", float(int(string[2:], 16)))
@@ -285,19 +947,75 @@ class _tokenizer:
 
         return ("identifier", string)
 
-    def token_list_to_str(tokens: list[token]) -> str:
-        string = ""
-        last_token = _tokenizer.token("line_break", "\n")
+    def token_text(tokens: list[token]): # Yields the mlog text of tokens piece by piece
+        last_type = "line_break"
         for token in tokens:
-            if token.type == "line_break" or last_token.type == "line_break":
-                string += str(token)
-            else:
-                string += " " + str(token)
-            last_token = token
-        return string
+            if token.type != "line_break" and last_type != "line_break":
+                yield " "
+            yield str(token)
+            last_type = token.type
+
+    def token_list_to_str(tokens: list[token]) -> str:
+        return "".join(_tokenizer.token_text(tokens))
+
+    def write_tokens(tokens: list[token], stream: io.TextIOBase, chunk_size: int = 8192): # Streams the mlog text of tokens, joining a chunk of pieces per write
+        chunk = []
+        for piece in _tokenizer.token_text(tokens):
+            chunk.append(piece)
+            if len(chunk) >= chunk_size:
+                stream.write("".join(chunk))
+                chunk.clear()
+        stream.write("".join(chunk))
 
 class _executer:
     CONDITIONS = ["equal", "notEqual", "lessThan", "greaterThan", "lessThanEq", "greaterThanEq", "strictEqual"]
+
+    def angle_diff(a, b):
+        a = ((a % 360) + 360) % 360
+        b = ((b % 360) + 360) % 360
+        return min(a - b + 360 if (a - b) < 0 else a - b, b - a + 360 if (b - a) < 0 else b - a)
+
+    # Math operations on two resolved operands, shared by pop and lop, 'rand' is handled by eval_math since it needs the build context
+    MATH_OPERATIONS = {
+        "add": lambda a, b: a + b,
+        "sub": lambda a, b: a - b,
+        "mul": lambda a, b: a * b,
+        "div": lambda a, b: a / b,
+        "idiv": lambda a, b: a // b,
+        "mod": lambda a, b: a % b,
+        "pow": lambda a, b: pow(a, b),
+        "equal": lambda a, b: a == b,
+        "notEqual": lambda a, b: a != b,
+        "land": lambda a, b: a and b,
+        "lessThan": lambda a, b: a < b,
+        "lessThanEq": lambda a, b: a <= b,
+        "greaterThan": lambda a, b: a > b,
+        "greaterThanEq": lambda a, b: a >= b,
+        "strictEqual": lambda a, b: a == b,
+        "shl": lambda a, b: int(a) << int(b),
+        "shr": lambda a, b: int(a) >> int(b),
+        "or": lambda a, b: int(a) | int(b),
+        "and": lambda a, b: int(a) & int(b),
+        "xor": lambda a, b: int(a) ^ int(b),
+        "not": lambda a, b: ~int(a),
+        "max": lambda a, b: max(a, b),
+        "min": lambda a, b: min(a, b),
+        "angle": lambda a, b: math.degrees(math.atan2(a, b)),
+        "angleDiff": angle_diff,
+        "len": lambda a, b: math.hypot(a, b),
+        "abs": lambda a, b: abs(a),
+        "log": lambda a, b: math.log(a),
+        "log10": lambda a, b: math.log10(a),
+        "floor": lambda a, b: math.floor(a),
+        "ceil": lambda a, b: math.ceil(a),
+        "sqrt": lambda a, b: math.sqrt(a),
+        "sin": lambda a, b: math.sin(a),
+        "cos": lambda a, b: math.cos(a),
+        "tan": lambda a, b: math.tan(a),
+        "asin": lambda a, b: math.asin(a),
+        "acos": lambda a, b: math.acos(a),
+        "atan": lambda a, b: math.atan(a)
+    }
     DEFAULT_GLOBALS = {
         "PROCESSOR_TYPE":  _tokenizer.token("content", "@micro-processor"),
         "SCHEMATIC_NAME":  _tokenizer.token("string", '"SFMlog Schematic"'),
@@ -311,7 +1029,7 @@ class _executer:
             self.not_text = not_text
 
     class Instructions:
-        BLOCK_INSTRUCTIONS = ["defmac", "deffun", "proc", "if", "while", "for", "discard"]
+        BLOCK_INSTRUCTIONS = ["defmac", "defpure", "deffun", "proc", "if", "while", "for", "discard"]
 
         def init_instructions(executer):
             inst = _executer.Instructions
@@ -319,6 +1037,7 @@ class _executer:
             executer.init_instruction("block", inst.I_block, not_text=True)
             executer.init_instruction("proc", inst.I_proc, not_text=True)
             executer.init_instruction("defmac", inst.I_defmac)
+            executer.init_instruction("defpure", inst.I_defmac)
             executer.init_instruction("mac", inst.I_mac)
             executer.init_instruction("deffun", inst.I_deffun)
             executer.init_instruction("fun", inst.I_fun)
@@ -326,6 +1045,7 @@ class _executer:
             executer.init_instruction("type", inst.I_type)
             executer.init_instruction("pset", inst.I_pset)
             executer.init_instruction("pop", inst.I_pop)
+            executer.init_instruction("lop", inst.I_lop)
             executer.init_instruction("strop", inst.I_strop)
             executer.init_instruction("strlabel", inst.I_strlabel)
             executer.init_instruction("strvar", inst.I_strvar)
@@ -338,9 +1058,12 @@ class _executer:
             executer.init_instruction("discard", inst.I_discard)
             executer.init_instruction("log", inst.I_log)
             executer.init_instruction("error", inst.I_error)
+            executer.init_instruction("drawimage", inst.I_drawimage)
 
-        def I_import(inst, executer): # Imports and executes a separate sfmlog file
-            import_file = executer.resolve_var(inst[1])
+        def I_import(inst, executer): # Imports and executes a separate sfmlog file, 'import once' only runs it the first time in each proc
+            once = 2 in inst and inst[1].type == "identifier" and inst[1].value == "once"
+            path_token = inst[2] if once else inst[1]
+            import_file = executer.resolve_var(path_token)
             if import_file.type == "string":
                 import_file = pathlib.Path(import_file.value[1:-1])
             else:
@@ -350,19 +1073,57 @@ class _executer:
                     import_file = pathlib.Path(__file__).resolve().parent / import_file
                 else:
                     import_file = executer.cwd / import_file
-            try:
-                with open(import_file, "r") as file:
-                    import_code = file.read()
-            except FileNotFoundError:
-                _error(f"File '{import_file}' not found", inst[1], executer)
-            import_tokenizer = _tokenizer(import_code, import_file)
-            import_executer = executer.child(inst, import_tokenizer.tokens)
+            for trace in executer.traces:
+                trace.files.add(import_file)
+            if once:
+                executer.trace_impure() # Whether it runs depends on what the proc imported before, which a replay can't know
+                if import_file in executer.imported_once:
+                    return
+                executer.imported_once.add(import_file)
+            memo_key = ("import", import_file, executer.scope_str)
+            memo = executer.memo_cache.get(memo_key) # Libraries are executed once and their definitions replayed after that
+            if memo is not None and executer.trace_valid(memo):
+                executer.output.extend(executer.replay_trace(memo)[0])
+                return
+            if executer.profiler is not None:
+                executer.profiler.push(f"import {import_file.name}")
+            if executer.stats is not None:
+                executer.stats.start("tokenize")
+            import_tokens = _bundle.load(import_file)
+            if import_tokens is not None:
+                executer.context.record_input(_bundle.path_for(import_file))
+            else:
+                try:
+                    with open(import_file, "r") as file:
+                        import_code = file.read()
+                except FileNotFoundError:
+                    _error(f"File '{import_file}' not found", path_token, executer)
+                import_tokens = _tokenizer(import_code, import_file).tokens
+            if import_file.exists():
+                executer.context.record_input(import_file)
+            if executer.stats is not None:
+                executer.stats.stop("tokenize")
+                executer.stats.source_tokens += len(import_tokens)
+            import_executer = executer.child(inst, import_tokens)
             import_executer.cwd = import_file.parent
             import_executer.owners = executer.owners + [inst]
-            import_executer.execute()
+            executer.context.limits.check_depth(inst[0], import_executer)
+            trace = import_executer.begin_trace()
+            try:
+                import_executer.execute()
+            except RecursionError as error:
+                _executer.mark_recursion(error, inst, import_executer)
+                raise
+            import_executer.end_trace(trace)
+            trace.output = import_executer.output
+            if not trace.impure and len(trace.output) == 0 and not trace.leaks_scope():
+                executer.memo_cache[memo_key] = trace
             executer.output.extend(import_executer.output)
+            if executer.profiler is not None:
+                executer.profiler.pop(len(import_executer.output))
 
         def I_block(inst, executer): # Adds a block to the schematic
+            executer.trace_impure()
             var_name = inst[1]
             if var_name.type not in ["identifier", "global_identifier"]:
                 _error("Invalid variable name", var_name, executer)
@@ -387,6 +1148,7 @@ class _executer:
                 executer.write_var(var_name, _tokenizer.token("block", link_name))
 
         def I_proc(inst, executer): # Adds a processor to the schematic
+            executer.trace_impure()
             proc_code = executer.read_till("end", _executer.Instructions.BLOCK_INSTRUCTIONS)
             if proc_code is None:
                 _error("'end' expected, but not found", inst[0], executer)
@@ -395,8 +1157,22 @@ class _executer:
             proc_executer.vars = {}
             proc_executer.macro_run_counts = {}
             proc_executer.called_functions = []
+            proc_executer.imported_once = set()
+            proc_executer.call_graph = {}
             proc_executer.is_processor = True
-            proc_executer.execute()
+            cached = None
+            if executer.cache is not None and executer.schem_builder is not None: # Reuses the code of an unchanged proc from a previous build
+                proc_key = executer.cache.proc_key(proc_code, executer.cwd)
+                cached = executer.cache.load_proc(proc_key, proc_executer)
+                trace = proc_executer.begin_trace() if cached is None else None
+            if cached is None:
+                if executer.profiler is not None:
+                    executer.profiler.push(f"proc {_profiler.location(inst[0])}")
+                proc_executer.execute()
+                if executer.profiler is not None:
+                    executer.profiler.pop(len(proc_executer.output), into_parent=False)
+            elif executer.stats is not None:
+                executer.stats.proc_instructions.append(cached[1])
             if 4 in inst:
                 proc_type = executer.resolve_var(inst[2])
             elif 2 in inst:
@@ -412,11 +1188,25 @@ class _executer:
             else:
                 pos = None
             if executer.schem_builder is not None:
-                proc_name = executer.schem_builder.add_proc(executer.schem_builder.Proc(_tokenizer.token_list_to_str(proc_executer.output), pos, proc_type, executer, inst))
+                if cached is not None:
+                    proc_code = cached[0]
+                else:
+                    if executer.stats is not None:
+                        executer.stats.start("serialize")
+                    proc_code = _tokenizer.token_list_to_str(proc_executer.output)
+                    if executer.stats is not None:
+                        executer.stats.stop("serialize")
+                    if executer.cache is not None:
+                        for name in proc_executer.called_functions:
+                            trace.read("fun", proc_executer.functions, name)
+                        proc_executer.end_trace(trace)
+                        if not trace.impure and not trace.files and not any(kind != "var" for kind, _ in trace.writes):
+                            executer.cache.store_proc(proc_key, trace, proc_code, sum(1 for token in proc_executer.output if token.type == "instruction"))
+                proc_name = executer.schem_builder.add_proc(executer.schem_builder.Proc(proc_code, pos, proc_type, executer, inst))
                 if 1 in inst:
                     executer.write_var(inst[1], _tokenizer.token("block", proc_name))
 
-        def I_defmac(inst, executer): # Defines a macro
+        def I_defmac(inst, executer): # Defines a macro, 'defpure' macros have their expansions cached
             mac_code = executer.read_till("end", _executer.Instructions.BLOCK_INSTRUCTIONS)
             if mac_code is None:
                 _error("'end' expected, but not found", inst[0], executer)
@@ -427,12 +1217,15 @@ class _executer:
             mac_args = []
             for index, arg in enumerate(inst.tokens[2:-1]):
                 if arg.type not in ["identifier", "expansion_identifier"]:
-                    _error("Invalid name for macro argument", arg, executer, inst[1], executer)
+                    _error("Invalid name for macro argument", arg, executer)
                 if arg.type == "expansion_identifier":
                     if index < (len(inst.tokens[2:-1]) - 1):
                         _error("Invalid use of expansion identifier not at end of macro definition", arg, executer)
                 mac_args.append(arg)
-            executer.macros[inst[1].value] = _Macro(inst[1].value, mac_code, mac_args, executer.cwd)
+            mac = _Macro(inst[1].value, mac_code, mac_args, executer.cwd, pure=inst[0].value == "defpure")
+            executer.macros[inst[1].value] = mac
+            if executer.traces:
+                executer.trace_write("mac", executer.macros, inst[1].value, mac)
 
         def I_mac(inst, executer): # Calls a macro
             mac_token = executer.resolve_var(inst[1])
@@ -440,11 +1233,11 @@ class _executer:
                 mac = mac_token.value
                 if mac.name not in executer.macro_run_counts:
                     executer.macro_run_counts[mac.name] = 0
-                mac_executer = executer.child(inst, mac.code, )
-                mac_executer.scope_str = f"m_{mac.name}_{executer.macro_run_counts[mac.name]}_"
-                mac_executer.owners = executer.owners + [executer.spawn_instruction]
-                mac_executer.cwd = mac.cwd
-                mac_executer.vars = {}
+                if executer.profiler is not None:
+                    executer.profiler.push(f"mac {mac.name}")
+                    output_start = len(executer.output)
+                if executer.stats is not None:
+                    executer.stats.macro_calls[mac.name] = executer.stats.macro_calls.get(mac.name, 0) + 1
 
                 raw_call_args = inst.tokens[2:-1]
                 call_args = []
@@ -462,34 +1255,76 @@ class _executer:
                     else:
                         call_args.append(arg)
 
+                arg_values = []
                 for index, arg in enumerate(mac.args):
                     if arg.type == "identifier":
                         var_token = call_args[index] if len(call_args) > index else executer.convert_to_var(None)
-                        mac_executer.write_var(arg, executer.resolve_var(var_token))
+                        arg_values.append((arg, executer.resolve_var(var_token)))
                     elif arg.type == "expansion_identifier":
                         remaining_args = call_args[index:] if len(call_args) > index else []
                         remaining_args_resolved = []
                         for rarg in remaining_args:
                             remaining_args_resolved.append(executer.resolve_var(rarg))
-                        mac_executer.write_var(arg.as_type("identifier"), executer.convert_to_var(remaining_args_resolved))
-
-                mac_executer.macros = executer.macros.copy()
-
-                executer.macro_run_counts[mac.name] += 1
-                mac_executer.execute()
-                executer.output.extend(mac_executer.output)
-                out_vals = []
-                for index, arg in enumerate(mac.args):
-                    if arg.type in ["identifier", "global_identifier"] and len(call_args) > index:
-                        out_vals.append(mac_executer.resolve_var(arg))
-                    elif arg.type == "expansion_identifier" and len(call_args) > index:
-                        lst_var = mac_executer.resolve_var(arg.as_type("identifier"))
-                        if lst_var.type != "list":
-                            lst = [lst_var]
-                        else:
-                            lst = lst_var.value
-                        for val in lst:
-                            out_vals.append(mac_executer.resolve_var(val))
+                        arg_values.append((arg.as_type("identifier"), executer.convert_to_var(remaining_args_resolved)))
+
+                memo = None
+                if mac.pure:
+                    memo_key = (mac, len(call_args), tuple(_token_sig(value) for _, value in arg_values))
+                    memo = executer.memo_cache.get(memo_key)
+                    if memo is not None and not executer.trace_valid(memo):
+                        memo = None
+
+                if memo is not None:
+                    mac_output, out_vals = executer.replay_trace(memo)
+                    executer.output.extend(mac_output)
+                else:
+                    mac_executer = executer.child(inst, mac.code, )
+                    mac_executer.scope_str = f"m_{mac.name}_{executer.macro_run_counts[mac.name]}_"
+                    mac_executer.owners = executer.owners + [executer.spawn_instruction]
+                    executer.context.limits.check_depth(inst[0], mac_executer)
+                    mac_executer.cwd = mac.cwd
+                    mac_executer.vars = {}
+                    for arg, value in arg_values:
+                        mac_executer.write_var(arg, value)
+
+                    mac_executer.macros = _overlay(executer.macros)
+                    for trace in executer.traces:
+                        trace.alias("mac", mac_executer.macros, executer.macros)
+                    if mac.pure:
+                        trace = mac_executer.begin_trace(track_vars=False, track_macros=False)
+                        trace.aliases[id(mac_executer.macros)] = mac_executer.macros
+
+                    executer.macro_run_counts[mac.name] += 1
+                    try:
+                        mac_executer.execute()
+                    except RecursionError as error:
+                        _executer.mark_recursion(error, inst, mac_executer)
+                        raise
+                    executer.output.extend(mac_executer.output)
+                    out_vals = []
+                    for index, arg in enumerate(mac.args):
+                        if arg.type in ["identifier", "global_identifier"] and len(call_args) > index:
+                            out_vals.append(mac_executer.resolve_var(arg))
+                        elif arg.type == "expansion_identifier" and len(call_args) > index:
+                            lst_var = mac_executer.resolve_var(arg.as_type("identifier"))
+                            if lst_var.type != "list":
+                                lst = [lst_var]
+                            else:
+                                lst = lst_var.value
+                            for val in lst:
+                                out_vals.append(mac_executer.resolve_var(val))
+
+                    if mac.pure:
+                        mac_executer.end_trace(trace)
+                        trace.output = mac_executer.output
+                        trace.values = [_Trace.rescope(x, {}) for x in out_vals]
+                        # Arguments mutated in place (e.g. 'list set' on a passed in list) can't be replayed
+                        mutated = memo_key[2] != tuple(_token_sig(value) for _, value in arg_values)
+                        if not trace.impure and not mutated and not trace.leaks_scope():
+                            executer.memo_cache[memo_key] = trace
+
+                if executer.profiler is not None:
+                    executer.profiler.pop(len(executer.output) - output_start)
 
                 for index, arg in enumerate(raw_call_args):
                     if arg.type in ["identifier", "global_identifier"]:
@@ -509,6 +1344,9 @@ class _executer:
                 _error("'end' expected, but not found", inst[0], executer)
             if inst[1].type != "identifier":
                 _error("Invalid name for function", inst[1], executer)
+            if executer.traces:
+                executer.trace_lookup("fun", executer.functions, inst[1].value)
+                executer.trace_lookup("mac", executer.macros, inst[1].value)
             if inst[1].value in executer.functions:
                 _error(f"Function '{inst[1].value}' is already defined", inst[1], executer)
             if inst[1].value in executer.macros:
@@ -530,7 +1368,10 @@ class _executer:
                 else:
                     arg_direction = "in"
                 fun_args.append((out_token, arg_direction))
-            executer.functions[inst[1].value] = _Function(inst[1].value, fun_code, fun_args, executer.cwd)
+            func = _Function(inst[1].value, fun_code, fun_args, executer.cwd)
+            executer.functions[inst[1].value] = func
+            if executer.traces:
+                executer.trace_write("fun", executer.functions, inst[1].value, func)
 
         def I_fun(inst, executer): # Calls a function
             func_token = executer.resolve_var(inst[1])
@@ -538,6 +1379,9 @@ class _executer:
                 func = func_token.value
                 if func.name not in executer.called_functions:
                     executer.called_functions.append(func.name)
+                executer.record_call(func.name, inst[0])
+                for trace in executer.traces:
+                    trace.calls.append((func.name, inst[0]))
                 for index, arg in enumerate(func.args):
                     if arg[1] in ["in", "inout"] and inst[index+2].value != "_":
                         executer.output.extend([_tokenizer.token("instruction", "set"), arg[0], executer.resolve_var(inst[2+index]).with_scope(executer.scope_str), _tokenizer.token("line_break", "\n")])
@@ -568,16 +1412,62 @@ class _executer:
         def I_pop(inst, executer): # Performs math operations
             executer.write_var(inst[2], executer.eval_math(inst[1], executer.resolve_var(inst[3]), executer.resolve_var(inst[4] if 4 in inst else executer.convert_to_var(None))))
 
+        def I_lop(inst, executer): # Performs a math operation on every item of a list, each operand can be a list or a single value
+            operation = inst[1]
+            operands = [executer.resolve_var(inst[3]), executer.resolve_var(inst[4]) if 4 in inst else executer.convert_to_var(None)]
+            lengths = sorted({len(operand.value) for operand in operands if operand.type == "list"})
+            if not lengths:
+                _error("Expected at least one list operand", inst[3], executer)
+            if len(lengths) > 1:
+                _error(f"List operands have different lengths {lengths[0]} and {lengths[1]}", inst[4], executer)
+            length = lengths[0]
+            try:
+                values = None
+                packed = [_vector.pack(operand.value) if operand.type == "list" else executer.coerce_num(operand) for operand in operands]
+                if None not in packed:
+                    values = _vector.apply(operation.value, packed[0], packed[1], length)
+                if values is not None:
+                    out = _TokenList(_tokenizer.token("number", value) for value in values)
+                else: # Non numeric items or operations without a fast path go through eval_math one item at a time
+                    items = [operand.value if operand.type == "list" else itertools.repeat(operand, length) for operand in operands]
+                    out = _TokenList(executer.eval_math(operation, a, b) for a, b in zip(*items))
+            except (ZeroDivisionError, ValueError, OverflowError) as e:
+                _error(f"Math error in '{operation.value}': {e}", operation, executer)
+            executer.write_var(inst[2], executer.convert_to_var(out))
+
         def I_strop(inst, executer): # Performs string operations
             str_op = inst[1]
             str_out = inst[2]
-            str_in = executer.resolve_string(inst[3])
+            str_in = executer.resolve_string(inst[3]) if str_op.value not in ["builder", "append", "build", "join"] else None
             out_val = None
             match str_op.value:
                 case "cat":
                     out_val = ""
                     for token in inst.tokens[3:-1]:
                         out_val += executer.resolve_string(token)
+                case "builder": # Creates a string builder, optionally starting with some pieces
+                    builder = _StringBuilder()
+                    for token in inst.tokens[3:-1]:
+                        builder.append(executer.resolve_string(token))
+                    executer.write_var(str_out, executer.convert_to_var(builder))
+                case "append": # Adds pieces to the end of a string builder
+                    builder = executer.resolve_var(str_out)
+                    if builder.type != "builder":
+                        _error(f"Expected type 'builder', got type '{builder.type}'", str_out, executer)
+                    for token in inst.tokens[3:-1]:
+                        builder.value.append(executer.resolve_string(token))
+                    executer.write_var(str_out, builder)
+                case "build": # Turns a string builder into a string
+                    builder = executer.resolve_var(inst[3])
+                    if builder.type != "builder":
+                        _error(f"Expected type 'builder', got type '{builder.type}'", inst[3], executer)
+                    out_val = builder.value.text()
+                case "join": # Joins the items of a list with an optional separator
+                    lst = executer.resolve_var(inst[3])
+                    if lst.type != "list":
+                        _error(f"Expected type 'list', got type '{lst.type}'", inst[3], executer)
+                    separator = executer.resolve_string(inst[4]) if 4 in inst else ""
+                    out_val = separator.join([executer.resolve_string(item) for item in lst.value])
                 case "num":
                     try:
                         out_val = float(str_in)
@@ -607,18 +1497,18 @@ class _executer:
                 case "rematch":
                     pattern = executer.resolve_string(inst[4])
                     try:
-                        match_val = re.search(pattern, str_in)
+                        match_val = _compile_regex(pattern).search(str_in)
                         if match_val is not None:
                             out_val = match_val[0]
                         else:
                             executer.write_var(str_out, executer.convert_to_var(None))
                     except re.PatternError as e:
-                        _error(f"Invalid regex pattern: {e.message}", inst[5], executer)
+                        _error(f"Invalid regex pattern: {e.msg}", inst[4], executer)
                 case "refind":
                     string = executer.resolve_string(inst[4])
                     pattern = executer.resolve_string(inst[5])
                     try:
-                        match_val = re.search(pattern, string)
+                        match_val = _compile_regex(pattern).search(string)
                         if match_val is not None:
                             executer.write_var(inst[2], executer.convert_to_var(match_val.start()))
                             executer.write_var(inst[3], executer.convert_to_var(match_val.end()))
@@ -626,23 +1516,29 @@ class _executer:
                             executer.write_var(inst[2], executer.convert_to_var(None))
                             executer.write_var(inst[3], executer.convert_to_var(None))
                     except re.PatternError as e:
-                        _error(f"Invalid regex pattern: {e.message}", inst[5], executer)
+                        _error(f"Invalid regex pattern: {e.msg}", inst[5], executer)
                 case "regroups":
                     pattern = executer.resolve_string(inst[4])
                     try:
-                        match_val = re.search(pattern, str_in)
+                        match_val = _compile_regex(pattern).search(str_in)
                         if match_val is not None:
                             out_val = match_val.groups()
                         else:
                             executer.write_var(str_out, executer.convert_to_var(None))
                     except re.PatternError as e:
-                        _error(f"Invalid regex pattern: {e.message}", inst[4], executer)
+                        _error(f"Invalid regex pattern: {e.msg}", inst[4], executer)
                 case "rematchall":
                     pattern = executer.resolve_string(inst[4])
                     try:
-                        out_val = re.findall(pattern, str_in)
+                        out_val = _compile_regex(pattern).findall(str_in)
                     except re.PatternError as e:
-                        _error(f"Invalid regex pattern: {e.message}", inst[4], executer)
+                        _error(f"Invalid regex pattern: {e.msg}", inst[4], executer)
+                case "refindall": # Finds every match as a list of [start, end, match, groups...]
+                    pattern = executer.resolve_string(inst[4])
+                    try:
+                        out_val = [[match_val.start(), match_val.end(), match_val[0], *match_val.groups()] for match_val in _compile_regex(pattern).finditer(str_in)]
+                    except re.PatternError as e:
+                        _error(f"Invalid regex pattern: {e.msg}", inst[4], executer)
             
             if out_val is not None:    
                 executer.write_var(str_out, executer.convert_to_var(out_val))
@@ -669,7 +1565,7 @@ class _executer:
                 case "unscoped":
                     token_type == "unscoped_identifier"
                 case _:
-                    _error(f"Unknown variable context '{inst[1].value}'", executer)
+                    _error(f"Unknown variable context '{inst[1].value}'", inst[1], executer)
 
             executer.write_var(var_out, _tokenizer.token(token_type, str_in.value[1:-1].replace(" ", "_")))
 
@@ -777,12 +1673,7 @@ class _executer:
                     else:
                         lst = []
                     if executer.resolve_var(input_list).type == "list":
-                        for index, elem in enumerate(lst):
-                            if elem.type == input_elem.type and elem.value == input_elem.value:
-                                executer.write_var(output, executer.convert_to_var(index))
-                                break
-                        else:
-                            executer.write_var(output, executer.convert_to_var(-1))
+                        executer.write_var(output, executer.convert_to_var(lst.find(input_elem)))
                     else:
                         executer.write_var(output, executer.convert_to_var(None))
                 case "in": # Checks if item is in list
@@ -795,12 +1686,84 @@ class _executer:
                     else:
                         lst = []
                     if executer.resolve_var(input_list).type == "list":
-                        for elem in lst:
-                            if elem.type == input_elem.type and elem.value == input_elem.value:
-                                executer.write_var(output, executer.convert_to_var(1))
-                                break
-                        else:
-                            executer.write_var(output, executer.convert_to_var(0))
+                        executer.write_var(output, executer.convert_to_var(lst.find(input_elem) != -1))
+                    else:
+                        executer.write_var(output, executer.convert_to_var(None))
+                case "sort": # Sorts a list in place, by the item at a key when it holds lists or tables
+                    lst_var = inst[2]
+                    var = executer.resolve_var(lst_var)
+                    lst = var.value if var.type == "list" else _TokenList()
+                    if 3 in inst:
+                        key = executer.resolve_var(inst[3])
+                        def item_key(item):
+                            try:
+                                if item.type == "list" and key.type == "number":
+                                    return _sort_key(item.value[int(key.value)])
+                                elif item.type == "table":
+                                    return _sort_key(item.value[executer.convert_var_to_py(key)])
+                            except (IndexError, KeyError):
+                                pass
+                            _error(f"List item of type '{item.type}' has no key '{key.value}'", inst[3], executer)
+                        lst.sort(key=item_key)
+                    else:
+                        lst.sort(key=_sort_key)
+                    executer.write_var(lst_var, executer.convert_to_var(lst))
+                case "reverse": # Reverses a list in place
+                    lst_var = inst[2]
+                    var = executer.resolve_var(lst_var)
+                    lst = var.value if var.type == "list" else _TokenList()
+                    lst.reverse()
+                    executer.write_var(lst_var, executer.convert_to_var(lst))
+                case "unique": # Removes repeated items, keeping the first of each
+                    lst_var = inst[2]
+                    var = executer.resolve_var(lst_var)
+                    lst = var.value if var.type == "list" else _TokenList()
+                    seen = set()
+                    kept = _TokenList()
+                    for item in lst:
+                        try:
+                            seen_key = (item.type, item.value)
+                            hash(seen_key)
+                        except TypeError:
+                            seen_key = _token_sig(item)
+                        if seen_key not in seen:
+                            seen.add(seen_key)
+                            kept.append(item)
+                    executer.write_var(lst_var, executer.convert_to_var(kept))
+                case "extend": # Appends every item of another list
+                    lst_var = inst[2]
+                    var = executer.resolve_var(lst_var)
+                    lst = var.value if var.type == "list" else _TokenList()
+                    other = executer.resolve_var(inst[3])
+                    if other.type != "list":
+                        _error(f"Expected type 'list', got type '{other.type}'", inst[3], executer)
+                    lst.extend(list(other.value))
+                    executer.write_var(lst_var, executer.convert_to_var(lst))
+                case "slice": # Copies the items from start up to end, negative indices count from the end
+                    output = inst[2]
+                    var = executer.resolve_var(inst[3])
+                    lst = var.value if var.type == "list" else _TokenList()
+                    start = executer.resolve_var(inst[4])
+                    if start.type != "number":
+                        _error(f"Expected type 'number', got type '{start.type}'", inst[4], executer)
+                    end = None
+                    if 5 in inst:
+                        end = executer.resolve_var(inst[5])
+                        if end.type != "number":
+                            _error(f"Expected type 'number', got type '{end.type}'", inst[5], executer)
+                        end = int(end.value)
+                    executer.write_var(output, executer.convert_to_var(_TokenList(lst[int(start.value):end])))
+                case "sum" | "min" | "max": # Reduces a list to a single number
+                    output = inst[2]
+                    var = executer.resolve_var(inst[3])
+                    lst = var.value if var.type == "list" else []
+                    values = _vector.pack(lst)
+                    if values is None:
+                        values = [executer.coerce_num(item) for item in lst]
+                    if inst[1].value == "sum":
+                        executer.write_var(output, executer.convert_to_var(sum(values)))
+                    elif values:
+                        executer.write_var(output, executer.convert_to_var(min(values) if inst[1].value == "min" else max(values)))
                     else:
                         executer.write_var(output, executer.convert_to_var(None))
                 case _:
@@ -890,33 +1853,37 @@ class _executer:
                     else:
                         tbl = {}
                     executer.write_var(output, executer.convert_to_var(len(tbl)))
-                # json excluded for now because it's basically useless for sfmlog
-                #case "readjson": # Creates a table from a json string
-                #    output_table = inst[2]
-                #    input_str = executer.resolve_var(inst[3])
-                #    if input_str.type == "string":
-                #        executer.write_var(output_table, executer.convert_to_var(json.loads(input_str.value[1:-1]), expand_strings=True))
-                #case "writejson": # Creates a json string from a table
-                #    output_str = inst[2]
-                #    input_table = inst[3]
-                #    if input_table.type in ["identifier", "global_identifier"]:
-                #        var = executer.resolve_var(input_table)
-                #        tbl = dill.loads(dill.dumps(var.value)) if var.type == "table" else {}
-                #    else:
-                #        tbl = {}
-                #    executer.write_var(output_str, executer.convert_to_var(json.dumps(executer.convert_var_to_py(executer.resolve_var(input_table)))))
+                case "readjson": # Creates a table or list from a json string
+                    output_table = inst[2]
+                    input_str = executer.resolve_var(inst[3])
+                    if input_str.type != "string":
+                        _error(f"Expected type 'string', got type '{input_str.type}'", inst[3], executer)
+                    try:
+                        executer.write_var(output_table, executer.convert_to_var(json.loads(executer.resolve_string(input_str))))
+                    except json.JSONDecodeError as e:
+                        _error(f"Invalid json: {e.msg}", inst[3], executer)
+                case "writejson": # Creates a json string from a table or list
+                    output_str = inst[2]
+                    input_table = executer.resolve_var(inst[3])
+                    if input_table.type not in ["table", "list"]:
+                        _error(f"Expected type 'table' or 'list', got type '{input_table.type}'", inst[3], executer)
+                    executer.write_var(output_str, executer.convert_to_var(json.dumps(executer.convert_var_to_py(input_table))))
                 case _:
                     _error(f"Unknown table operation \"{inst[1].value}\"", inst[1], executer) 
 
         def I_file(inst, executer): # Performs file operations
+            executer.trace_impure()
             output_var = inst[2]
             match inst[1].value:
                 case "open":
                     path = pathlib.Path(executer.resolve_string(inst[3]))
                     if not path.is_absolute():
                         path = executer.global_cwd / path
+                    executer.context.record_input(path)
                     try:
-                        executer.write_var(output_var, executer.convert_to_var(open(path, "r")))
+                        file = open(path, "r")
+                        executer.open_files.append(file)
+                        executer.write_var(output_var, executer.convert_to_var(file))
                     except FileNotFoundError:
                         _error(f"File {path} not found", inst[3], executer)
                     except OSError as e:
@@ -925,10 +1892,13 @@ class _executer:
                     path = pathlib.Path(executer.resolve_string(inst[3]))
                     if not path.is_absolute():
                         path = executer.global_cwd / path
+                    executer.context.record_input(path)
                     try:
-                        executer.write_var(output_var, executer.convert_to_var(open(path, "rb")))
+                        file = _BinFile(path)
                     except FileNotFoundError:
                         _error(f"File {path} not found", inst[3], executer)
+                    executer.open_files.append(file)
+                    executer.write_var(output_var, executer.convert_to_var(file))
                 case "close":
                     file = executer.resolve_var(inst[2])
                     if file.type not in ["text_file", "bin_file"]:
@@ -939,6 +1909,12 @@ class _executer:
                     if file.type != "text_file":
                         _error(f"Expected type 'text_file', got type '{file.type}'", inst[3], executer)
                     executer.write_var(output_var, executer.convert_to_var(file.value.read()))
+                case "readline": # Reads the next line, or null at the end of the file
+                    file = executer.resolve_var(inst[3])
+                    if file.type != "text_file":
+                        _error(f"Expected type 'text_file', got type '{file.type}'", inst[3], executer)
+                    line = file.value.readline()
+                    executer.write_var(output_var, executer.convert_to_var(line.removesuffix("\n") if line != "" else None))
                 case "readbytes":
                     file = executer.resolve_var(inst[3])
                     count = executer.resolve_var(inst[4])
@@ -955,7 +1931,105 @@ class _executer:
                     if endianness.value not in ['"big"', '"little"']:
                         _error("Invalid endianness, should be 'big' or 'little'", inst[5], executer)
                     executer.write_var(output_var, executer.convert_to_var(int.from_bytes(file.value.read(int(count.value)), byteorder=executer.resolve_string(endianness))))
-        
+                case "readarray": # Reads a list of fixed width integers in one go
+                    file = executer.resolve_var(inst[3])
+                    count = executer.resolve_var(inst[4])
+                    width = executer.resolve_var(inst[5])
+                    endianness = executer.resolve_var(inst.option(6, executer.convert_to_var('"big"')))
+                    signed = executer.resolve_var(inst.option(7, executer.convert_to_var(False)))
+                    if file.type != "bin_file":
+                        _error(f"Expected type 'bin_file', got type '{file.type}'", inst[3], executer)
+                    if count.type != "number":
+                        _error(f"Expected type 'number', got type '{count.type}'", inst[4], executer)
+                    if width.type != "number":
+                        _error(f"Expected type 'number', got type '{width.type}'", inst[5], executer)
+                    if width.value > 32 or width.value <= 0:
+                        _error("Byte width should be between 1 and 32", inst[5], executer)
+                    if endianness.type != "string" or endianness.value not in ['"big"', '"little"']:
+                        _error("Invalid endianness, should be 'big' or 'little'", inst[6], executer)
+                    width = int(width.value)
+                    data = file.value.read(int(count.value) * width if count.value >= 0 else -1)
+                    data = data[:len(data) - len(data) % width]
+                    executer.write_var(output_var, executer.convert_to_var(executer.decode_ints(data, width, executer.resolve_string(endianness), bool(executer.coerce_num(signed)))))
+                case "readimage": # Decodes a PPM/PGM, BMP or raw image into a list of rows of colors
+                    path = pathlib.Path(executer.resolve_string(inst[3]))
+                    if not path.is_absolute():
+                        path = executer.global_cwd / path
+                    size = None
+                    if 5 in inst:
+                        width = executer.resolve_var(inst[4])
+                        height = executer.resolve_var(inst[5])
+                        if width.type != "number" or height.type != "number":
+                            _error("Expected numeric image size", inst[4], executer)
+                        size = (int(width.value), int(height.value))
+                    executer.context.record_input(path)
+                    try:
+                        with open(path, "rb") as file:
+                            rows = _image.decode(file.read(), size, executer.resolve_string(inst.option(6, executer.convert_to_var('"rgba"'))))
+                    except FileNotFoundError:
+                        _error(f"File {path} not found", inst[3], executer)
+                    except (ValueError, IndexError) as e:
+                        _error(f"Failed to read image: {e}", inst[3], executer)
+                    executer.write_var(output_var, executer.convert_to_var(rows))
+                case "readcsv": # Parses a CSV file into a list of lists, or a list of tables if header is true
+                    source = executer.resolve_var(inst[3])
+                    delimiter = executer.resolve_var(inst.option(4))
+                    header = executer.resolve_var(inst.option(5))
+                    delimiter = executer.resolve_string(delimiter) if delimiter.type != "null" else ","
+                    header = executer.coerce_num(header) != 0 if header.type != "null" else False
+                    if source.type == "text_file":
+                        rows = list(_csv.rows(source.value, delimiter, header))
+                    else:
+                        path = executer.resolve_path(inst[3])
+                        executer.context.record_input(path)
+                        try:
+                            with open(path, "r") as file:
+                                rows = list(_csv.rows(file, delimiter, header))
+                        except FileNotFoundError:
+                            _error(f"File {path} not found", inst[3], executer)
+                    executer.write_var(output_var, executer.convert_to_var(rows))
+                case "readjson": # Parses a json file into a table or list
+                    source = executer.resolve_var(inst[3])
+                    try:
+                        if source.type == "text_file":
+                            data = json.load(source.value)
+                        else:
+                            path = executer.resolve_path(inst[3])
+                            executer.context.record_input(path)
+                            with open(path, "r") as file:
+                                data = json.load(file)
+                    except FileNotFoundError:
+                        _error(f"File {path} not found", inst[3], executer)
+                    except json.JSONDecodeError as e:
+                        _error(f"Invalid json: {e.msg}", inst[3], executer)
+                    executer.write_var(output_var, executer.convert_to_var(data))
+                case "seek": # Moves the read position of a binary file
+                    file = executer.resolve_var(inst[2])
+                    pos = executer.resolve_var(inst[3])
+                    if file.type != "bin_file":
+                        _error(f"Expected type 'bin_file', got type '{file.type}'", inst[2], executer)
+                    if pos.type != "number":
+                        _error(f"Expected type 'number', got type '{pos.type}'", inst[3], executer)
+                    whence = {"start": 0, "current": 1, "end": 2}.get(executer.resolve_string(inst.option(4, executer.convert_to_var('"start"'))))
+                    if whence is None:
+                        _error("Invalid seek origin, should be 'start', 'current' or 'end'", inst[4], executer)
+                    try:
+                        file.value.seek(int(pos.value), whence)
+                    except ValueError:
+                        _error("Seek position out of range", inst[3], executer)
+                case "tell": # Gets the read position of a binary file
+                    file = executer.resolve_var(inst[3])
+                    if file.type != "bin_file":
+                        _error(f"Expected type 'bin_file', got type '{file.type}'", inst[3], executer)
+                    executer.write_var(output_var, executer.convert_to_var(file.value.tell()))
+                case "size": # Gets the size of a binary file
+                    file = executer.resolve_var(inst[3])
+                    if file.type != "bin_file":
+                        _error(f"Expected type 'bin_file', got type '{file.type}'", inst[3], executer)
+                    executer.write_var(output_var, executer.convert_to_var(file.value.size()))
+                case _:
+                    _error(f"Unknown file operation \"{inst[1].value}\"", inst[1], executer)
+
         def I_if(inst, executer): # Runs code depending on a condition
             code_sections = executer.read_sections("end", _executer.Instructions.BLOCK_INSTRUCTIONS, ["elif", "else"])
             if code_sections is None:
@@ -973,6 +2047,8 @@ class _executer:
             if code_block is None:
                 _error("'end' expected, but not found", inst[0], executer)
             while executer.eval_condition(inst[1], executer.resolve_var(inst[2]), executer.resolve_var(inst.option(3))).value:
+                if executer.context.limits.active: # Counts iterations too, so an empty loop can't run forever
+                    executer.context.limits.step(inst[0], executer)
                 block_executer = executer.child(executer.spawn_instruction, code_block)
                 block_executer.execute()
                 executer.output.extend(block_executer.output)
@@ -1007,6 +2083,31 @@ class _executer:
                     if tbl.type != "table":
                         _error(f"Expected type 'table', got '{tbl.type}'", inst[4], executer)
                     for_iter = dill.loads(dill.dumps(tbl.value)).items()
+                case "lines": # Iterates over the lines of a text file without reading it all at once
+                    file = executer.resolve_var(inst[3])
+                    if file.type != "text_file":
+                        _error(f"Expected type 'text_file', got '{file.type}'", inst[3], executer)
+                    for_iter = (line.removesuffix("\n") for line in file.value)
+                case "csv": # Iterates over the rows of a CSV file without reading it all at once
+                    file = executer.resolve_var(inst[3])
+                    if file.type != "text_file":
+                        _error(f"Expected type 'text_file', got '{file.type}'", inst[3], executer)
+                    delimiter = executer.resolve_var(inst.option(4))
+                    header = executer.resolve_var(inst.option(5))
+                    delimiter = executer.resolve_string(delimiter) if delimiter.type != "null" else ","
+                    header = executer.coerce_num(header) != 0 if header.type != "null" else False
+                    for_iter = (executer.convert_to_var(row) for row in _csv.rows(file.value, delimiter, header))
+                case "chunks": # Iterates over fixed size chunks of a file, binary chunks are lists of bytes
+                    file = executer.resolve_var(inst[3])
+                    size = executer.resolve_var(inst[4])
+                    if file.type not in ["text_file", "bin_file"]:
+                        _error(f"Expected file, got '{file.type}'", inst[3], executer)
+                    if size.type != "number" or size.value < 1:
+                        _error("Chunk size should be a number of at least 1", inst[4], executer)
+                    if file.type == "text_file":
+                        for_iter = iter(lambda: file.value.read(int(size.value)), "")
+                    else:
+                        for_iter = (list(chunk) for chunk in iter(lambda: file.value.read(int(size.value)), b""))
 
             for i in for_iter:
                 if isinstance(i, tuple):
@@ -1023,24 +2124,56 @@ class _executer:
             if code_block is None:
                 _error("'end' expected, but not found", inst[0], executer)
             block_executer = executer.child(executer.spawn_instruction, code_block)
-            block_executer.macros = executer.macros.copy()
-            block_executer.functions = executer.functions.copy()
-            block_executer.vars = executer.vars.copy()
-            block_executer.global_vars = executer.global_vars.copy()
+            block_executer.macros = _overlay(executer.macros)
+            block_executer.functions = _overlay(executer.functions)
+            block_executer.vars = _overlay(executer.vars)
+            block_executer.global_vars = _overlay(executer.global_vars)
             block_executer.macro_run_counts = {}
             block_executer.schem_builder = None
+            for trace in executer.traces:
+                trace.alias("mac", block_executer.macros, executer.macros)
+                trace.alias("fun", block_executer.functions, executer.functions)
+                trace.alias("var", block_executer.vars, executer.vars)
+                trace.alias("global", block_executer.global_vars, executer.global_vars)
             block_executer.execute()
+            if len(block_executer.macro_run_counts) > 0:
+                executer.trace_impure() # Scopes from the sandbox's own macro counts can't be rewritten
             for arg in inst.tokens[1:-1]:
                 if arg.type not in ["identifier", "global_identifier"]:
                     _error(f"Expected type 'identifier' or 'global_identifier' but got type '{arg.type}'", arg, executer)
                 executer.write_var(arg, block_executer.resolve_var(arg))
             
         def I_log(inst, executer): # Writes out to the console
-            print("".join(map(executer.resolve_string ,inst.tokens[1:-1])))
+            executer.trace_impure()
+            executer.context.message("".join(map(executer.resolve_string ,inst.tokens[1:-1])))
 
         def I_error(inst, executer):
             _error("".join(map(executer.resolve_string ,inst.tokens[1:-1])), inst[0], executer)
 
+        def I_drawimage(inst, executer): # Draws an image from 'file readimage' to a display using merged rectangles
+            image = executer.resolve_var(inst[1])
+            display = executer.resolve_var(inst[2])
+            if image.type != "list":
+                _error(f"Expected type 'list', got type '{image.type}'", inst[1], executer)
+            if not display.exportable:
+                _error(f"Unable to output type '{display.type}' to mlog", inst[2], executer)
+            pos = (executer.coerce_num(executer.resolve_var(inst.option(3))), executer.coerce_num(executer.resolve_var(inst.option(4))))
+            scale = executer.resolve_var(inst.option(5, executer.convert_to_var(1)))
+            if scale.type != "number":
+                _error(f"Expected type 'number', got type '{scale.type}'", inst[5], executer)
+            rows = []
+            for row in image.value:
+                if row.type != "list" or any(pixel.type != "color" for pixel in row.value):
+                    _error("Expected image to be a list of rows of colors", inst[1], executer)
+                rows.append([pixel.value for pixel in row.value])
+            for batch in _image.draw_batches(rows, pos, scale.value):
+                for command in batch:
+                    executer.output.append(_tokenizer.token("instruction", "draw").at_token(inst[0]))
+                    executer.output.append(_tokenizer.token("sub_instruction", command[0]))
+                    executer.output.extend(executer.convert_to_var(arg) for arg in command[1:])
+                    executer.output.append(_tokenizer.token("line_break", "\n"))
+                executer.output.extend([_tokenizer.token("instruction", "drawflush").at_token(inst[0]), display, _tokenizer.token("line_break", "\n")])
+
     class InstructionLine:
         def __init__(self, tokens, executer):
             self.tokens = tokens
@@ -1096,16 +2229,30 @@ class _executer:
         self.macro_run_counts: dict[str, int] = {}
         self.functions: dict[str, _Function] = {}
         self.called_functions: list[str] = []
-        self.vars: dict[str, _tokenizer.token] = {}
+        self.imported_once: set[pathlib.Path] = set() # Files 'import once' already ran in this proc, or outside of procs
+        self.call_graph: dict[str, dict[str, _tokenizer.token]] = {} # caller -> callee -> first call token, only for calls made from function bodies
+        self.function_name: str | None = None
+        self.vars: dict[tuple[str, str], _tokenizer.token] = {} # (scope, name) -> value
         self.global_vars: dict[str, _tokenizer.token] = {}
         self.allow_mlog = True
         self.is_root = False
         self.schem_builder = None
         self.is_processor = False
         self.as_text = False
+        self.traces: list[_Trace] = []
+        self.memo_cache: dict[tuple, _Trace] = {}
+        self.open_files: list[io.TextIOWrapper | _BinFile] = []
+        self.profiler: _profiler | None = None
+        self.context: _BuildContext | None = None # Set once for the root executer and shared through child()
+        self.cache: _OutputCache | None = None
+        self.stats: _stats | None = None
 
         self.exec_pointer = 0
 
+    def mark_recursion(error: RecursionError, inst, executer): # Remembers where the stack ran out, only the innermost site is kept
+        if not hasattr(error, "sfmlog_site"):
+            error.sfmlog_site = (inst, executer)
+
     def child(self, spawn_instruction, code: list[_tokenizer.token]):
         executer = _executer(spawn_instruction, code)
         executer.scope_str = self.scope_str
@@ -1115,18 +2262,33 @@ class _executer:
         executer.macros: dict[str, _Macro] = self.macros
         executer.functions: dict[str, _Function] = self.functions
         executer.called_functions: list[str] = self.called_functions
+        executer.imported_once = self.imported_once
+        executer.call_graph = self.call_graph
+        executer.function_name = self.function_name
         executer.macro_run_counts: dict[str, int] = self.macro_run_counts
-        executer.vars: dict[str, _tokenizer.token] = self.vars
+        executer.vars: dict[tuple[str, str], _tokenizer.token] = self.vars
         executer.global_vars: dict[str, _tokenizer.token] = self.global_vars
         executer.schem_builder = self.schem_builder
         executer.as_text = self.as_text
+        executer.traces = self.traces
+        executer.memo_cache = self.memo_cache
+        executer.open_files = self.open_files
+        executer.profiler = self.profiler
+        executer.context = self.context
+        executer.cache = self.cache
+        executer.stats = self.stats
+        if self.stats is not None:
+            self.stats.executers += 1
         return executer
 
     def execute(self):
+        limits = self.context.limits
         while True:
             if self.exec_pointer >= len(self.lines):
                 break
             inst = self.lines[self.exec_pointer]
+            if limits.active:
+                limits.step(inst[0], self)
             
             self.exec_instruction(inst)
 
@@ -1134,13 +2296,22 @@ class _executer:
                 _error("Mlog instructions not allowed outside a 'proc' statement", inst[0], self)
             self.exec_pointer += 1
         if self.is_processor or self.is_root and self.as_text:
+            if self.stats is not None:
+                self.stats.start("expand_functions")
             self.expand_functions()
             self.check_func_recursion()
+            if self.stats is not None:
+                self.stats.stop("expand_functions")
+                self.stats.start("post_process")
             self.output = _post_processor.process(self.output)
+            if self.stats is not None:
+                self.stats.stop("post_process")
+                self.stats.output_tokens += len(self.output)
+                self.stats.proc_instructions.append(sum(1 for token in self.output if token.type == "instruction"))
         if self.is_root:
-            self.schem_builder.processor_type = self.global_vars["global_PROCESSOR_TYPE"]
-            self.schem_builder.set_name(self.resolve_string(self.global_vars["global_SCHEMATIC_NAME"]))
-            self.schem_builder.set_desc(self.resolve_string(self.global_vars["global_SCHEMATIC_DESCRIPTION"]))
+            self.schem_builder.processor_type = self.global_vars["PROCESSOR_TYPE"]
+            self.schem_builder.set_name(self.resolve_string(self.global_vars["SCHEMATIC_NAME"]))
+            self.schem_builder.set_desc(self.resolve_string(self.global_vars["SCHEMATIC_DESCRIPTION"]))
 
     def read_till(self, end_word: str, start_word: list[str]) -> list[_tokenizer.token] | None: #None if eof, token if unexpected end
         lines = self.read_lines_till(end_word, start_word)
@@ -1209,7 +2380,7 @@ class _executer:
         self.schem_builder.root_exec = self
         self.global_cwd: pathlib.Path = self.cwd
         for name, value in self.DEFAULT_GLOBALS.items():
-            self.global_vars[f"global_{name}"] = value
+            self.global_vars[name] = value
 
     def convert_to_var(self, value):
         match value:
@@ -1224,8 +2395,12 @@ class _executer:
                 return _tokenizer.token("content", value)
             case str():
                 return _tokenizer.token("string", '"' + value + '"' )
+            case _TokenList():
+                return _tokenizer.token("list", value, exportable = False)
+            case _StringBuilder():
+                return _tokenizer.token("builder", value, exportable = False)
             case list() | tuple():
-                lst = []
+                lst = _TokenList()
                 for item in value:
                     lst.append(self.convert_to_var(item))
                 return _tokenizer.token("list", lst, exportable = False)
@@ -1242,7 +2417,7 @@ class _executer:
                 return _tokenizer.token("color", value)
             case io.TextIOWrapper():
                 return _tokenizer.token("text_file", value, exportable = False)
-            case io.BufferedReader():
+            case _BinFile():
                 return _tokenizer.token("bin_file", value, exportable = False)
             case None:
                 return _tokenizer.token("null", "null")
@@ -1264,21 +2439,25 @@ class _executer:
             case "table":
                 return {k: self.convert_var_to_py(v) for k, v in var.value.items()}
             case "color":
-                return (var.r, var.g, var.b, var.a)
+                return (var.value.r, var.value.g, var.value.b, var.value.a)
+            case "builder":
+                return var.value.text()
             case "expansion_identifier":
                 _error("Unexpected expansion identifier", var, self)
             case _:
                 raise Exception(f"Unable to convert type '{var.type}'")
 
     def resolve_var(self, name: _tokenizer.token):
+        if self.traces:
+            self.trace_resolve(name)
         if name.type == "identifier" and name.value in self.macros:
             return self.convert_to_var(self.macros[name.value]).with_scope(self.scope_str).at_token(name)
         elif name.type == "identifier" and name.value in self.functions:
             return self.convert_to_var(self.functions[name.value]).with_scope(self.scope_str).at_token(name)
-        elif name.type == "identifier" and str(name) in self.vars:
-            return self.vars[str(name)].with_scope(self.scope_str).at_token(name)
-        elif name.type == "global_identifier" and str(name) in self.global_vars:
-            return self.global_vars[str(name)].with_scope("").at_token(name)
+        elif name.type == "identifier" and (name.scope, name.value) in self.vars:
+            return self.vars[(name.scope, name.value)].with_scope(self.scope_str).at_token(name)
+        elif name.type == "global_identifier" and name.value in self.global_vars:
+            return self.global_vars[name.value].with_scope("").at_token(name)
         elif name.type == "content" and (return_value := self.resolve_special(str(name))) is not None:
             return self.convert_to_var(return_value)
         elif name.type == "expansion_identifier":
@@ -1293,6 +2472,8 @@ class _executer:
             return f'[{", ".join([self.resolve_output(x) for x in self.resolve_var(token).value])}]'
         elif self.resolve_var(token).type == "table":
             return f'{{{", ".join([f"{str(k)}: {self.resolve_output(v)}" for k, v in self.resolve_var(token).value.items()])}}}'
+        elif self.resolve_var(token).type == "builder":
+            return self.resolve_var(token).value.text()
         else:
             return str(self.resolve_var(token))
 
@@ -1304,25 +2485,127 @@ class _executer:
         else:
             return str(self.resolve_var(token))
 
+    def resolve_path(self, token: _tokenizer.token) -> pathlib.Path:
+        path = pathlib.Path(self.resolve_string(token))
+        if not path.is_absolute():
+            path = self.global_cwd / path
+        return path
+
     def resolve_special(self, name: str) -> any:
         match name:
             case "@cwd":
                 return str(self.cwd)
             case "@ctime":
-                return float(time.time()*1000)
+                return self.context.ctime()
             case "@ptime":
-                return float(time.process_time()*1000)
+                return self.context.ptime()
 
     def write_var(self, name: _tokenizer.token, value: _tokenizer.token):
+        if self.context.limits.max_collection is not None:
+            self.context.limits.check_collection(name, value, self)
         if name.type == "identifier":
             if name.value != '_':
-                self.vars[str(name)] = value
+                self.vars[(name.scope, name.value)] = value
+                if self.traces:
+                    self.trace_write("var", self.vars, (name.scope, name.value), value)
         elif name.type == "global_identifier":
-            self.global_vars[str(name)] = value
+            self.global_vars[name.value] = value
+            if self.traces:
+                self.trace_write("global", self.global_vars, name.value, value)
         else:
             return False
         return True
 
+    def begin_trace(self, track_vars=True, track_macros=True) -> _Trace:
+        trace = _Trace(self, track_vars, track_macros)
+        self.traces.append(trace)
+        return trace
+
+    def end_trace(self, trace: _Trace):
+        self.traces.remove(trace)
+        trace.finish(self)
+
+    def trace_tables(self) -> dict[str, dict]:
+        return {"var": self.vars, "global": self.global_vars, "mac": self.macros, "fun": self.functions}
+
+    def trace_lookup(self, kind: str, table: dict, key):
+        for trace in self.traces:
+            trace.read(kind, table, key)
+
+    def trace_resolve(self, name: _tokenizer.token):
+        if name.type == "identifier":
+            self.trace_lookup("mac", self.macros, name.value)
+            if name.value not in self.macros:
+                self.trace_lookup("fun", self.functions, name.value)
+                if name.value not in self.functions:
+                    self.trace_lookup("var", self.vars, (name.scope, name.value))
+        elif name.type == "global_identifier":
+            self.trace_lookup("global", self.global_vars, name.value)
+        elif name.type == "content" and name.value in ["@ctime", "@ptime"]:
+            self.trace_impure()
+
+    def trace_write(self, kind: str, table: dict, key, value):
+        for trace in self.traces:
+            trace.write(kind, table, key, value)
+
+    def trace_impure(self):
+        for trace in self.traces:
+            trace.impure = True
+
+    def trace_valid(self, trace: _Trace) -> bool: # Checks that everything a recorded trace read still has the same value
+        tables = self.trace_tables()
+        for (kind, key), value in trace.reads.items():
+            current = tables[kind].get(key)
+            if kind in ["var", "global"] and current is not None:
+                current = _token_sig(current)
+            if current != value:
+                return False
+        return True
+
+    def replay_trace(self, trace: _Trace) -> tuple[list[_tokenizer.token], list[_tokenizer.token]]: # Applies a recorded trace as if its code was executed again
+        scope_map = {}
+        for name, start, count in trace.run_counts:
+            base = self.macro_run_counts.get(name, 0)
+            if base != start:
+                for i in range(count):
+                    scope_map[f"m_{name}_{start + i}_"] = f"m_{name}_{base + i}_"
+            self.macro_run_counts[name] = base + count
+        for name in trace.called:
+            if name not in self.called_functions:
+                self.called_functions.append(name)
+        for name, token in trace.calls:
+            self.record_call(name, token)
+            for outer in self.traces:
+                outer.calls.append((name, token))
+        for outer in self.traces:
+            outer.files.update(trace.files)
+        tables = self.trace_tables()
+        for (kind, key), value in trace.reads.items():
+            for outer in self.traces:
+                if (kind, key) not in outer.reads and (kind, key) not in outer.written and outer.tracks(kind, tables[kind]):
+                    outer.reads[(kind, key)] = value
+        for (kind, key), value in trace.writes.items():
+            if kind in ["var", "global"]:
+                value = _Trace.rescope(value, scope_map)
+            tables[kind][key] = value
+            if self.traces:
+                self.trace_write(kind, tables[kind], key, value)
+        if scope_map:
+            output = [_Trace.rescope(x, scope_map) for x in trace.output]
+        else:
+            output = trace.output
+        return output, [_Trace.rescope(x, scope_map) for x in trace.values]
+
+    def decode_ints(self, data: bytes, width: int, byteorder: str, signed: bool) -> list[int]:
+        typecodes = {(1, False): "B", (2, False): "H", (4, False): "I", (8, False): "Q", (1, True): "b", (2, True): "h", (4, True): "i", (8, True): "q"}
+        typecode = typecodes.get((width, signed))
+        if typecode is not None and array.array(typecode).itemsize == width:
+            values = array.array(typecode, data)
+            if byteorder != sys.byteorder and width > 1:
+                values.byteswap()
+            return values.tolist()
+        return [int.from_bytes(data[i:i + width], byteorder=byteorder, signed=signed) for i in range(0, len(data), width)]
+
     def coerce_num(self, token: _tokenizer.token) -> float:
         if token.type == "number":
             return token.value
@@ -1343,91 +2626,13 @@ class _executer:
             a = self.coerce_num(input1)
             b = self.coerce_num(input2)
 
-        match operation.value:
-            case "add":
-                out = a + b
-            case "sub":
-                out = a - b
-            case "mul":
-                out = a * b
-            case "div":
-                out = a / b
-            case "idiv":
-                out = a // b
-            case "mod":
-                out = a % b
-            case "pow":
-                out = pow(a,b)
-            case "equal":
-                out = a == b
-            case "notEqual":
-                out = a != b
-            case "land":
-                out = a and b
-            case "lessThan":
-                out = a < b
-            case "lessThanEq":
-                out = a <= b
-            case "greaterThan":
-                out = a > b
-            case "greaterThanEq":
-                out = a >= b
-            case "strictEqual":
-                if input1.type != input2.type:
-                    out = 0
-                out = a == b
-            case "shl":
-                out = int(a) << int(b)
-            case "shr":
-                out = int(a) >> int(b)
-            case "or":
-                out = int(a) | int(b)
-            case "and":
-                out = int(a) & int(b)
-            case "xor":
-                out = int(a) ^ int(b)
-            case "not":
-                out = ~int(a)
-            case "max":
-                out = max(a, b)
-            case "min":
-                out = min(a, b)
-            case "angle":
-                out = math.degrees(math.atan2(a, b))
-            case "angleDiff":
-                a = ((a % 360) + 360) % 360
-                b = ((b % 360) + 360) % 360
-                out = min(a - b + 360 if (a - b) < 0 else a - b, b - a + 360 if (b - a) < 0 else b - a)
-            case "len":
-                out = math.hypot(a, b)
-            case "abs":
-                out = abs(a)
-            case "log":
-                out = math.log(a)
-            case "log10":
-                out = math.log10(a)
-            case "floor":
-                out = math.floor(a)
-            case "ceil":
-                out = math.ceil(a)
-            case "sqrt":
-                out = math.sqrt(a)
-            case "rand":
-                out = random.uniform(0,a)
-            case "sin":
-                out = math.sin(a)
-            case "cos":
-                out = math.cos(a)
-            case "tan":
-                out = math.tan(a)
-            case "asin":
-                out = math.asin(a)
-            case "acos":
-                out = math.acos(a)
-            case "atan":
-                out = math.atan(a)
-            case _:
-                _error(f"Unknown operation \"{operation.value}\"", operation, self)
+        if operation.value == "rand":
+            self.trace_impure()
+            out = self.context.rand(a)
+        elif operation.value in self.MATH_OPERATIONS:
+            out = self.MATH_OPERATIONS[operation.value](a, b)
+        else:
+            _error(f"Unknown operation \"{operation.value}\"", operation, self)
 
         return _tokenizer.token("number", float(out))
 
@@ -1461,12 +2666,7 @@ class _executer:
                     out = a == b
             case "in":
                 if input1.type == "list":
-                    for elem in input1.value:
-                        if elem.type == input2.type and elem.value == input2.value:
-                            out = 1
-                            break
-                    else:
-                        out = 0
+                    out = input1.value.find(input2) != -1
                 elif input1.type == "table":
                     out = self.convert_var_to_py(input2) in input1.value
                 else:
@@ -1481,6 +2681,8 @@ class _executer:
         self.instructions.append(instruction)
 
     def exec_instruction(self, inst):
+        if self.profiler is not None:
+            self.profiler.count_instruction()
         for i in self.instructions:
             if inst[0].value == i.keyword:
                 if i.not_text and self.as_text:
@@ -1503,46 +2705,295 @@ class _executer:
             for func_name in self.called_functions:
                 func = self.functions[func_name]
                 self.output.extend([_tokenizer.token("label", func.name+":").with_scope("function_") ,_tokenizer.token("line_break", "\n")])
+                if self.profiler is not None:
+                    self.profiler.push(f"fun {func.name}")
                 func_executer = self.child(self.spawn_instruction, func.code)
                 func_executer.scope_str = f"f_{func.name}_"
-                func_executer.execute()
-                self.output.extend(func_executer.output)
+                func_executer.function_name = func.name
+                memo_key = ("fun", func) # Function bodies are lowered once and replayed in every proc that calls them
+                memo = self.memo_cache.get(memo_key)
+                if memo is not None and func_executer.trace_valid(memo):
+                    func_output, _ = func_executer.replay_trace(memo)
+                else:
+                    trace = func_executer.begin_trace()
+                    func_executer.execute()
+                    func_executer.end_trace(trace)
+                    func_output = trace.output = func_executer.output
+                    if not trace.impure and not trace.leaks_scope():
+                        self.memo_cache[memo_key] = trace
+                self.output.extend(func_output)
+                if self.profiler is not None:
+                    self.profiler.pop(len(func_output))
                 self.output.extend([_tokenizer.token("instruction", "set"), _tokenizer.token("content", "@counter"), _tokenizer.token("identifier",f"{func.name}_return").with_scope("function_"), _tokenizer.token("line_break", "\n")])
 
-    def check_func_recursion(self): # I don't like this function :3
-        lines = self.read_lines(self.output)
-        functions = {}
-        func_name = None
-        in_funcdef = False
-
-        for inst in lines:
-            if inst[0].type == "label" and inst[0].scope == "function_":
-                in_funcdef = True
-                func_name = inst[0].value[:-1]
-                functions[func_name] = []
-            elif in_funcdef and inst[0].type == "instruction" and inst[0].value == "set" and inst[2].type == "identifier" and inst[2].scope == "function_":
-                in_funcdef = False
-            elif in_funcdef and inst[0].type == "instruction" and inst[0].value == "jump" and inst[1].type == "identifier" and inst[1].scope == "function_":
-                functions[func_name].append(inst[1].value)
-        for inst in lines:
-            if inst[0].type == "label" and inst[0].scope == "function_":
-                in_funcdef = True
-                func_name = inst[0].value[:-1]
-            elif in_funcdef and inst[0].type == "instruction" and inst[0].value == "set" and inst[2].type == "identifier" and inst[2].scope == "function_":
-                in_funcdef = False
-            elif in_funcdef and inst[0].type == "instruction" and inst[0].value == "jump" and inst[1].type == "identifier" and inst[1].scope == "function_":
-                checked_funcs = []
-                funcs_to_check = [inst[1].value]
-                while len(funcs_to_check) > 0:
-                    funcs_to_check_copy = funcs_to_check.copy()
-                    funcs_to_check = []
-                    for func in funcs_to_check_copy:
-                        checked_funcs.append(func)
-                        if func in functions and func_name in functions[func]:
-                            _error("Function recursion not allowed", inst[0], self)
-                        for new_func in functions[func]:
-                            if new_func not in checked_funcs and new_func not in funcs_to_check and new_func not in funcs_to_check_copy:
-                                funcs_to_check.append(new_func)
+    def record_call(self, func_name: str, token: _tokenizer.token):
+        if self.function_name is not None:
+            self.call_graph.setdefault(self.function_name, {}).setdefault(func_name, token)
+
+    def check_func_recursion(self): # Finds cycles in the call graph with Tarjan's strongly connected components algorithm
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+        def connect(func):
+            index[func] = lowlink[func] = len(index)
+            stack.append(func)
+            on_stack.add(func)
+            for callee in self.call_graph.get(func, {}):
+                if callee not in index:
+                    connect(callee)
+                    lowlink[func] = min(lowlink[func], lowlink[callee])
+                elif callee in on_stack:
+                    lowlink[func] = min(lowlink[func], index[callee])
+            if lowlink[func] == index[func]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    component.append(member)
+                    if member == func:
+                        break
+                components.append(component)
+        for func in self.call_graph:
+            if func not in index:
+                connect(func)
+        for component in components:
+            start = component[-1]
+            if len(component) == 1 and start not in self.call_graph.get(start, {}):
+                continue
+            members = set(component)
+            paths = {start: [start]} # Breadth first search for the shortest way back to the start of the cycle
+            queue = [start]
+            cycle = None
+            while cycle is None:
+                func = queue.pop(0)
+                for callee in self.call_graph[func]:
+                    if callee == start:
+                        cycle = paths[func] + [start]
+                        break
+                    if callee in members and callee not in paths:
+                        paths[callee] = paths[func] + [callee]
+                        queue.append(callee)
+            _error(f"Function recursion not allowed: {' -> '.join(cycle)}", self.call_graph[cycle[-2]][cycle[-1]], self)
+
+class _image:
+    DRAW_BUFFER_SIZE = 256
+
+    def decode(data: bytes, size: tuple[int, int] | None = None, raw_format: str = "rgba") -> list[list[_Color]]: # Decodes an image into rows of colors, top row first
+        if data[:2] == b"BM":
+            return _image._decode_bmp(data)
+        if data[:1] == b"P" and data[1:2] in [b"2", b"3", b"5", b"6"]:
+            return _image._decode_pnm(data)
+        if size is not None:
+            return _image._decode_raw(data, size, raw_format)
+        raise ValueError("Unknown image format, raw images need a width and height")
+
+    def _decode_raw(data: bytes, size: tuple[int, int], raw_format: str) -> list[list[_Color]]:
+        channels = {"gray": 1, "rgb": 3, "rgba": 4}.get(raw_format)
+        if channels is None:
+            raise ValueError("Invalid raw image format, should be 'gray', 'rgb' or 'rgba'")
+        width, height = size
+        if len(data) < width * height * channels:
+            raise ValueError("Raw image data is smaller than its size")
+        return _image._rows_from_bytes(data, width, height, channels)
+
+    def _rows_from_bytes(data: bytes, width: int, height: int, channels: int) -> list[list[_Color]]:
+        rows = []
+        stride = width * channels
+        for y in range(height):
+            row = data[y * stride:(y + 1) * stride]
+            if channels == 1:
+                rows.append([_Color(v, v, v, 255) for v in row])
+            elif channels == 3:
+                rows.append([_Color(r, g, b, 255) for r, g, b in zip(row[0::3], row[1::3], row[2::3])])
+            else:
+                rows.append([_Color(r, g, b, a) for r, g, b, a in zip(row[0::4], row[1::4], row[2::4], row[3::4])])
+        return rows
+
+    def _decode_pnm(data: bytes) -> list[list[_Color]]:
+        header = []
+        pos = 2
+        while len(header) < 3:
+            while pos < len(data) and data[pos:pos + 1].isspace():
+                pos += 1
+            if data[pos:pos + 1] == b"#":
+                while pos < len(data) and data[pos:pos + 1] not in [b"\n", b"\r"]:
+                    pos += 1
+                continue
+            start = pos
+            while pos < len(data) and not data[pos:pos + 1].isspace() and data[pos:pos + 1] != b"#":
+                pos += 1
+            if start == pos:
+                raise ValueError("Truncated image header")
+            header.append(int(data[start:pos]))
+        width, height, max_value = header
+        channels = 3 if data[1:2] in [b"3", b"6"] else 1
+        count = width * height * channels
+        if data[1:2] in [b"2", b"3"]:
+            values = [int(v) for v in data[pos:].split()[:count]]
+        else:
+            pos += 1
+            if max_value < 256:
+                values = list(data[pos:pos + count])
+            else:
+                values = array.array("H", data[pos:pos + count * 2])
+                if sys.byteorder == "little":
+                    values.byteswap()
+                values = values.tolist()
+        if len(values) < count:
+            raise ValueError("Image data is smaller than its size")
+        if max_value != 255:
+            values = [v * 255 // max_value for v in values]
+        return _image._rows_from_bytes(bytes(values), width, height, channels)
+
+    def _decode_bmp(data: bytes) -> list[list[_Color]]:
+        offset = int.from_bytes(data[10:14], "little")
+        header_size = int.from_bytes(data[14:18], "little")
+        width = int.from_bytes(data[18:22], "little", signed=True)
+        height = int.from_bytes(data[22:26], "little", signed=True)
+        bpp = int.from_bytes(data[28:30], "little")
+        compression = int.from_bytes(data[30:34], "little")
+        if bpp not in [24, 32] or compression not in [0, 3]:
+            raise ValueError("Only uncompressed 24 and 32 bit BMP images are supported")
+        masks = [0x00ff0000, 0x0000ff00, 0x000000ff, 0]
+        if compression == 3:
+            masks = [int.from_bytes(data[54 + i * 4:58 + i * 4], "little") for i in range(4 if header_size >= 56 else 3)] + [0]
+        stride = ((bpp * width + 31) // 32) * 4
+        rows = []
+        for y in range(abs(height)):
+            row = data[offset + y * stride:offset + y * stride + width * (bpp // 8)]
+            if bpp == 24:
+                rows.append([_Color(r, g, b, 255) for b, g, r in zip(row[0::3], row[1::3], row[2::3])])
+            else:
+                channels = [(mask, (mask & -mask).bit_length() - 1) for mask in masks[:4]]
+                colors = []
+                for i in range(0, len(row), 4):
+                    pixel = int.from_bytes(row[i:i + 4], "little")
+                    r, g, b, a = [((pixel & mask) >> shift) * 255 // (mask >> shift) if mask else 255 for mask, shift in channels]
+                    colors.append(_Color(r, g, b, a))
+                rows.append(colors)
+        if height > 0: # Positive heights are stored bottom row first
+            rows.reverse()
+        return rows
+
+    def to_rects(rows: list[list[_Color]]) -> dict[str, list[tuple[int, int, int, int]]]: # Merges pixels into as few same colored rectangles as possible, grouped by color
+        rects = {}
+        open_rects = {}
+        for y, row in enumerate(rows):
+            runs = {}
+            x = 0
+            while x < len(row):
+                color = row[x].to_hex()
+                start = x
+                while x < len(row) and row[x].to_hex() == color:
+                    x += 1
+                if color[6:8] != "00":
+                    runs[(start, x, color)] = True
+            next_rects = {}
+            for run in runs:
+                if run in open_rects:
+                    rect = open_rects.pop(run)
+                    rect[3] += 1
+                else:
+                    rect = [run[0], y, run[1] - run[0], 1]
+                    rects.setdefault(run[2], []).append(rect)
+                next_rects[run] = rect
+            open_rects = next_rects
+        return {color: [tuple(rect) for rect in color_rects] for color, color_rects in rects.items()}
+
+    def draw_batches(rows: list[list[_Color]], pos: tuple[float, float], scale: float) -> list[list[tuple]]: # Creates 'draw' commands split into batches that fit the graphics buffer
+        height = len(rows)
+        batches = [[]]
+        for color, rects in _image.to_rects(rows).items():
+            color_cmd = ("color", int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16), int(color[6:8], 16))
+            if len(batches[-1]) + 2 > _image.DRAW_BUFFER_SIZE:
+                batches.append([])
+            batches[-1].append(color_cmd)
+            for x, y, w, h in rects:
+                if len(batches[-1]) >= _image.DRAW_BUFFER_SIZE:
+                    batches.append([color_cmd])
+                batches[-1].append(("rect", pos[0] + x * scale, pos[1] + (height - y - h) * scale, w * scale, h * scale))
+        return [batch for batch in batches if len(batch) > 0]
+
+class _bundle: # Precompiled libraries, stored as marshalled tokens next to their source
+    MAGIC = b"SFMC"
+    VERSION = 2
+
+    def path_for(source: pathlib.Path) -> pathlib.Path:
+        return source.with_suffix(".sfmc")
+
+    def write(source: pathlib.Path) -> pathlib.Path:
+        with open(source, "r") as f:
+            tokens = _tokenizer(f.read(), source).tokens
+        packed = []
+        for token in tokens:
+            value = token.value.to_hex() if token.type == "color" else token.value
+            packed.append((token.type, value, token.line, token.column))
+        out = _bundle.path_for(source)
+        with open(out, "wb") as f:
+            f.write(_bundle.MAGIC + marshal.dumps((_bundle.VERSION, _OutputCache.version(), packed)))
+        return out
+
+    def read(path: pathlib.Path) -> list[tuple] | None: # None if the bundle is missing or was made by a different transpiler
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if data[:4] != _bundle.MAGIC:
+            return None
+        try:
+            version, transpiler, packed = marshal.loads(data[4:])
+        except (EOFError, ValueError, TypeError):
+            return None
+        if version != _bundle.VERSION or transpiler != _OutputCache.version():
+            return None
+        return packed
+
+    def load(source: pathlib.Path) -> list[_tokenizer.token] | None: # Tokens from the source's bundle, if it is present and newer than the source
+        path = _bundle.path_for(source)
+        try:
+            if source.exists() and path.stat().st_mtime < source.stat().st_mtime:
+                return None
+        except FileNotFoundError:
+            return None
+        packed = _bundle.read(path)
+        if packed is None:
+            return None
+        tokens = []
+        for token_type, value, line, column in packed:
+            if token_type == "color":
+                value = _Color.from_hex(value)
+            tokens.append(_tokenizer.token(token_type, value, line, column, source))
+        return tokens
+
+class _csv:
+    NUMBER_REGEX = re.compile(r"^(?:(?:-?[0-9]*\.[0-9]+)|(?:-?[0-9]+))(?:e[0-9]+)?$")
+    COMMENT_REGEX = re.compile(r"^\s*//")
+
+    def parse_cell(cell: str) -> str | float:
+        if _csv.NUMBER_REGEX.search(cell):
+            return float(cell)
+        elif cell == "true":
+            return 1.0
+        elif cell == "false":
+            return 0.0
+        return cell
+
+    def rows(lines, delimiter: str, header: bool): # Parses lines of CSV into typed lists, or tables keyed by the first line if header is true
+        header_cells = None
+        for line in lines:
+            line = line.removesuffix("\n")
+            if line == "" or _csv.COMMENT_REGEX.search(line):
+                continue
+            cells = line.split(delimiter)
+            if not header:
+                yield [_csv.parse_cell(cell) for cell in cells]
+            elif header_cells is None:
+                header_cells = cells
+            else:
+                yield {header_cells[i]: _csv.parse_cell(cell) for i, cell in enumerate(cells[:len(header_cells)])}
 
 class _post_processor:
     def process(code: list[_tokenizer.token]) -> list[_tokenizer.token]:
@@ -1614,6 +3065,12 @@ class _schem_builder:
         self.procs.append(proc)
         return f"processor{len(self.procs)}"
 
+    def write_procs(self, directory: pathlib.Path): # Writes each proc's code to a file named after its processor
+        directory.mkdir(parents=True, exist_ok=True)
+        for index, proc in enumerate(self.procs):
+            with open(directory / f"processor{index + 1}.mlog", "w") as f:
+                f.write(proc.code)
+
     def add_block(self, block):
         name = self.get_link_name(block.type_name)
         block.link_name = name
@@ -1726,31 +3183,455 @@ class _schem_builder:
         for index, iter_proc in enumerate(self.proc_positions):
             proc.links.append(pymsch.ProcessorLink(iter_proc[0] - proc_pos[0], iter_proc[1] - proc_pos[1], f"processor{index+1}"))
 
+class _stats:
+    PHASES = ["tokenize", "execute", "expand_functions", "post_process", "serialize", "make_schem"]
+
+    def __init__(self):
+        self.phases: dict[str, list[float]] = {name: [0.0, 0.0] for name in self.PHASES} # name -> [wall time, cpu time]
+        self.running: list[list] = [] # [name, wall start, cpu start] for each open phase, only the innermost one is being timed
+        self.source_tokens = 0
+        self.output_tokens = 0
+        self.executers = 0
+        self.macro_calls: dict[str, int] = {}
+        self.proc_instructions: list[int] = []
+        self.peak_memory_kb: int | None = None
+
+    def start(self, phase: str): # Pauses the enclosing phase, so nested phases like import tokenizing aren't counted twice and the phases add up
+        wall, cpu = time.perf_counter(), time.process_time()
+        if self.running:
+            self.add_time(self.running[-1], wall, cpu)
+        self.running.append([phase, wall, cpu])
+
+    def stop(self, phase: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        self.add_time(self.running.pop(), wall, cpu)
+        if self.running:
+            self.running[-1][1:] = [wall, cpu]
+
+    def add_time(self, entry: list, wall: float, cpu: float):
+        self.phases[entry[0]][0] += wall - entry[1]
+        self.phases[entry[0]][1] += cpu - entry[2]
+
+    def finish(self):
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak_memory_kb = peak // 1024 if sys.platform == "darwin" else peak
+
+    def to_dict(self) -> dict:
+        return {
+            "phases": {name: {"wall": wall, "cpu": cpu} for name, (wall, cpu) in self.phases.items()},
+            "tokens": {"source": self.source_tokens, "output": self.output_tokens},
+            "executers": self.executers,
+            "macro_calls": self.macro_calls,
+            "proc_instructions": self.proc_instructions,
+            "peak_memory_kb": self.peak_memory_kb
+        }
+
+    def report(self) -> str:
+        lines = [f"{'phase':<18} {'wall ms':>10} {'cpu ms':>10}"]
+        for name, (wall, cpu) in self.phases.items():
+            lines.append(f"{name:<18} {wall * 1000:>10.2f} {cpu * 1000:>10.2f}")
+        lines.append(f"source tokens: {self.source_tokens}, output tokens: {self.output_tokens}, executers: {self.executers}")
+        lines.append(f"macro calls: {sum(self.macro_calls.values())}, procs: {len(self.proc_instructions)}, mlog instructions: {sum(self.proc_instructions)}")
+        if self.peak_memory_kb is not None:
+            lines.append(f"peak memory: {self.peak_memory_kb} KiB")
+        return "\n".join(lines)
+
+class _profiler:
+    class Frame:
+        def __init__(self, name: str, start: float):
+            self.name = name
+            self.start = start
+            self.child_time = 0.0
+            self.child_tokens = 0
+            self.instructions = 0
+
+    def __init__(self):
+        self.stack: list[_profiler.Frame] = []
+        self.stacks: dict[tuple[str, ...], float] = {} # self time per call stack, for collapsed stack output
+        self.totals: dict[str, list] = {} # name -> [total time, self time, calls, instructions, tokens]
+
+    def location(token: _tokenizer.token) -> str:
+        return f"{token.file.name if token.file is not None else '<main>'}:{token.line}"
+
+    def push(self, name: str):
+        self.stack.append(self.Frame(name.replace(";", ","), time.perf_counter()))
+
+    def pop(self, tokens: int, into_parent: bool = True): # tokens is the number of tokens the frame emitted, including its children
+        frame = self.stack.pop()
+        elapsed = time.perf_counter() - frame.start
+        self_time = elapsed - frame.child_time
+        path = tuple(x.name for x in self.stack) + (frame.name,)
+        self.stacks[path] = self.stacks.get(path, 0.0) + self_time
+        totals = self.totals.setdefault(frame.name, [0.0, 0.0, 0, 0, 0])
+        if frame.name not in [x.name for x in self.stack]: # Don't count recursive frames twice
+            totals[0] += elapsed
+        totals[1] += self_time
+        totals[2] += 1
+        totals[3] += frame.instructions
+        totals[4] += tokens - frame.child_tokens
+        if len(self.stack) > 0:
+            self.stack[-1].child_time += elapsed
+            if into_parent:
+                self.stack[-1].child_tokens += tokens
+
+    def count_instruction(self):
+        if len(self.stack) > 0:
+            self.stack[-1].instructions += 1
+
+    def report(self) -> str:
+        lines = [f"{'total ms':>10} {'self ms':>10} {'calls':>7} {'insts':>9} {'tokens':>9}  name"]
+        for name, (total, self_time, calls, instructions, tokens) in sorted(self.totals.items(), key=lambda x: x[1][1], reverse=True):
+            lines.append(f"{total * 1000:>10.2f} {self_time * 1000:>10.2f} {calls:>7} {instructions:>9} {tokens:>9}  {name}")
+        return "\n".join(lines)
+
+    def write_collapsed(self, file: pathlib.Path): # Writes the self time of every call stack in microseconds, as used by flamegraph tools
+        with open(file, "w") as f:
+            for path, self_time in self.stacks.items():
+                f.write(f"{';'.join(path)} {round(self_time * 1_000_000)}\n")
+
+class _symbol_index: # Definitions found by scanning tokens, without running the preprocessor
+    class Symbol:
+        def __init__(self, kind: str, name: str, args: list[str], file: pathlib.Path, line: int, column: int, doc: str):
+            self.kind = kind
+            self.name = name
+            self.args = args
+            self.file = file
+            self.line = line
+            self.column = column
+            self.doc = doc
+
+        def signature(self) -> str:
+            if self.kind == "global":
+                return f"pset ${self.name}"
+            return " ".join([self.kind, self.name] + self.args)
+
+    KINDS = ("defmac", "defpure", "deffun")
+
+    def __init__(self):
+        self.files: dict[pathlib.Path, list[_symbol_index.Symbol]] = {}
+        self.by_name: dict[str, list[_symbol_index.Symbol]] = {}
+
+    def resolve_import(self, path: str, importer: pathlib.Path) -> pathlib.Path:
+        import_file = pathlib.Path(path)
+        if not import_file.is_absolute():
+            if len(import_file.parents) > 1 and str(import_file.parents[-2]) == "std":
+                import_file = pathlib.Path(__file__).resolve().parent / import_file
+            else:
+                import_file = importer.parent / import_file
+        return import_file.resolve()
+
+    def index_file(self, path: pathlib.Path, code: str | None = None, tokens: list[_tokenizer.token] | None = None):
+        path = path.resolve()
+        try:
+            if code is None:
+                with open(path, "r") as f:
+                    code = f.read()
+            if tokens is None:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    tokens = _tokenizer(code, path).tokens
+        except OSError: # The file is gone, so are its definitions
+            self.remove_file(path)
+            return
+        except (UnicodeDecodeError, _CompileError):
+            return
+        self.remove_file(path)
+        source_lines = code.split("\n")
+        symbols = []
+        imports = []
+        line = []
+        for token in tokens:
+            if token.type != "line_break":
+                line.append(token)
+                continue
+            if len(line) >= 2 and line[0].type == "instruction":
+                keyword = line[0].value
+                if keyword in self.KINDS and line[1].type == "identifier":
+                    args = [("$" + arg.value) if arg.type == "global_identifier" else (arg.value + "...") if arg.type == "expansion_identifier" else str(arg.value) for arg in line[2:]]
+                    symbols.append(self.Symbol(keyword, line[1].value, args, path, line[1].line, line[1].column, self.doc_comment(source_lines, line[0].line)))
+                elif keyword == "pset" and line[1].type == "global_identifier":
+                    symbols.append(self.Symbol("global", line[1].value, [], path, line[1].line, line[1].column, self.doc_comment(source_lines, line[0].line)))
+                elif keyword == "import" and line[-1].type == "string":
+                    imports.append(self.resolve_import(line[-1].value[1:-1], path))
+            line = []
+        self.files[path] = symbols
+        for symbol in symbols:
+            self.by_name.setdefault(symbol.name, []).append(symbol)
+        for import_file in imports:
+            if import_file not in self.files:
+                self.index_file(import_file)
+
+    def remove_file(self, path: pathlib.Path):
+        for symbol in self.files.pop(path.resolve(), []):
+            self.by_name[symbol.name].remove(symbol)
+
+    def doc_comment(self, source_lines: list[str], line: int) -> str: # The comment lines right above a definition
+        doc = []
+        index = line - 2
+        while index >= 0 and source_lines[index].strip().startswith("#"):
+            doc.insert(0, source_lines[index].strip().lstrip("#").strip())
+            index -= 1
+        return "\n".join(doc)
+
+    def lookup(self, name: str) -> list[Symbol]:
+        return self.by_name.get(name, [])
+
+    def complete(self, prefix: str) -> list[Symbol]:
+        return [symbols[0] for name, symbols in self.by_name.items() if name.startswith(prefix) and symbols]
+
+class _language_server: # Speaks the language server protocol over stdio
+    WORD_REGEX = re.compile(r"[^ \t;]+")
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.index = _symbol_index()
+        self.documents: dict[str, str] = {}
+        self.sessions: dict[str, _session] = {}
+        self.keywords = sorted({instruction.keyword for instruction in _executer(None, []).instructions} | set(_tokenizer.SUB_INSTRUCTION_MAP))
+        self.running = True
+
+    def uri_to_path(uri: str) -> pathlib.Path:
+        return pathlib.Path(urllib.request.url2pathname(urllib.parse.urlparse(uri).path))
+
+    def path_to_uri(path: pathlib.Path) -> str:
+        return path.resolve().as_uri()
+
+    def read_message(self) -> dict | None:
+        length = None
+        while True:
+            header = self.stdin.readline()
+            if header == b"":
+                return None
+            header = header.strip()
+            if header == b"":
+                break
+            name, _, value = header.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value.strip())
+        return json.loads(self.stdin.read(length))
+
+    def send(self, message: dict):
+        body = json.dumps(message).encode()
+        self.stdout.write(f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        self.stdout.flush()
+
+    def serve(self):
+        while self.running:
+            message = self.read_message()
+            if message is None:
+                break
+            method = message.get("method")
+            params = message.get("params", {})
+            handler = getattr(self, "on_" + method.replace("/", "_").replace("$", "_"), None) if method else None
+            if "id" not in message: # Notification
+                if handler is not None:
+                    try:
+                        handler(params)
+                    except (Exception, _CompileError) as error: # Nothing to answer, so the error goes on the document if there is one
+                        uri = params.get("textDocument", {}).get("uri")
+                        if uri is not None:
+                            self.send({"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics", "params": {"uri": uri, "diagnostics": [{"range": {"start": {"line": 0, "character": 0}, "end": {"line": 0, "character": 1}}, "severity": 1, "source": "sfmlog", "message": f"Internal error: {error!r}"}]}})
+            elif handler is None:
+                self.send({"jsonrpc": "2.0", "id": message["id"], "error": {"code": -32601, "message": f"Unknown method '{method}'"}})
+            else:
+                try:
+                    self.send({"jsonrpc": "2.0", "id": message["id"], "result": handler(params)})
+                except (Exception, _CompileError) as error:
+                    self.send({"jsonrpc": "2.0", "id": message["id"], "error": {"code": -32603, "message": f"Internal error: {error!r}"}})
+        for session in self.sessions.values():
+            session.close()
+
+    def on_initialize(self, params: dict) -> dict:
+        root = params.get("rootUri")
+        if root:
+            root = _language_server.uri_to_path(root)
+            for pattern in ["**/*.sfm", "**/*.sfmlib"]:
+                for path in root.glob(pattern):
+                    self.index.index_file(path)
+        for path in (pathlib.Path(__file__).resolve().parent / "std").glob("*.sfmlib"):
+            self.index.index_file(path)
+        return {"capabilities": {"textDocumentSync": 1, "definitionProvider": True, "hoverProvider": True, "completionProvider": {"triggerCharacters": ["$"]}}}
+
+    def on_shutdown(self, params: dict):
+        return None
+
+    def on_exit(self, params: dict):
+        self.running = False
+
+    def on_textDocument_didOpen(self, params: dict):
+        document = params["textDocument"]
+        self.changed(document["uri"], document["text"])
+
+    def on_textDocument_didChange(self, params: dict):
+        self.changed(params["textDocument"]["uri"], params["contentChanges"][-1]["text"])
+
+    def on_textDocument_didClose(self, params: dict):
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        session = self.sessions.pop(uri, None)
+        if session is not None:
+            session.close()
+
+    def on_workspace_didChangeWatchedFiles(self, params: dict):
+        for change in params.get("changes", []):
+            path = _language_server.uri_to_path(change["uri"])
+            if change.get("type") == 3: # Deleted
+                self.index.remove_file(path)
+            elif change["uri"] not in self.documents:
+                self.index.index_file(path)
+
+    def changed(self, uri: str, text: str): # Reindexes a document and sends its errors
+        self.documents[uri] = text
+        path = _language_server.uri_to_path(uri)
+        as_text = not re.search(r"^\s*proc\b", text, flags=re.M) # Rechecked on every change, adding the first proc turns a file into a schematic
+        if uri in self.sessions and self.sessions[uri].as_text != as_text:
+            self.sessions.pop(uri).close()
+        if uri not in self.sessions:
+            self.sessions[uri] = _session(path, as_text, 0)
+        session = self.sessions[uri]
+        result = session.update(text)
+        self.index.index_file(path, text, session.tokenizer.tokens if session.tokenizer is not None and not result.errors else None)
+        diagnostics = []
+        for error in result.errors:
+            if error.file is not None and error.file.resolve() != path.resolve():
+                message = f"{error.message} (in '{error.file}' at {error.line},{error.column})"
+                line, column = 0, 0
+            else:
+                message = error.message
+                line, column = max(0, (error.line or 1) - 1), max(0, (error.column or 1) - 1)
+            diagnostics.append({"range": {"start": {"line": line, "character": column}, "end": {"line": line, "character": column + 1}}, "severity": 1, "source": "sfmlog", "message": message})
+        self.send({"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics", "params": {"uri": uri, "diagnostics": diagnostics}})
+
+    def word_at(self, params: dict) -> tuple[str, int, int] | None: # The word under the cursor and where it starts and ends
+        text = self.documents.get(params["textDocument"]["uri"])
+        if text is None:
+            return None
+        lines = text.split("\n")
+        line = params["position"]["line"]
+        character = params["position"]["character"]
+        if line >= len(lines):
+            return None
+        for match in self.WORD_REGEX.finditer(lines[line]):
+            if match.start() <= character <= match.end():
+                return match[0], match.start(), match.end()
+        return None
+
+    def symbol_name(word: str) -> str:
+        return word.removeprefix("$").removesuffix("...").removesuffix(":")
+
+    def on_textDocument_definition(self, params: dict) -> list[dict]:
+        word = self.word_at(params)
+        if word is None:
+            return []
+        locations = []
+        for symbol in self.index.lookup(_language_server.symbol_name(word[0])):
+            position = {"line": symbol.line - 1, "character": symbol.column - 1}
+            locations.append({"uri": _language_server.path_to_uri(symbol.file), "range": {"start": position, "end": {"line": position["line"], "character": position["character"] + len(symbol.name)}}})
+        return locations
+
+    def on_textDocument_hover(self, params: dict) -> dict | None:
+        word = self.word_at(params)
+        if word is None:
+            return None
+        symbols = self.index.lookup(_language_server.symbol_name(word[0]))
+        if len(symbols) == 0:
+            return None
+        parts = []
+        for symbol in symbols:
+            parts.append(f"```sfmlog\n{symbol.signature()}\n```" + (f"\n{symbol.doc}" if symbol.doc else ""))
+        return {"contents": {"kind": "markdown", "value": "\n\n".join(parts)}}
+
+    def on_textDocument_completion(self, params: dict) -> list[dict]:
+        word = self.word_at(params)
+        prefix = word[0][:params["position"]["character"] - word[1]] if word is not None else ""
+        is_global = prefix.startswith("$")
+        prefix = _language_server.symbol_name(prefix)
+        items = []
+        for symbol in self.index.complete(prefix):
+            if (symbol.kind == "global") == is_global:
+                items.append({"label": symbol.name, "kind": 6 if symbol.kind == "global" else 3, "detail": symbol.signature(), "documentation": symbol.doc})
+        if not is_global:
+            items.extend({"label": keyword, "kind": 14} for keyword in self.keywords if keyword.startswith(prefix))
+        return items
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='sfmlog', description='A mindustry transpiler', epilog=':hognar:')
-    parser.add_argument('-s', '--src', required=True, type=pathlib.Path, help="the file to transpile", metavar="source_file")
+    parser.add_argument('-s', '--src', type=pathlib.Path, help="the file to transpile", metavar="source_file")
     parser.add_argument('-o', '--out', type=pathlib.Path, help="the file to write the output to", metavar="output_file")
     parser.add_argument('-c', '--copy', action='store_true', help="copy the output to the clipboard")
     parser.add_argument('-t', '--text', action='store_true', help="output code for one proc, rather than a schematic")
+    parser.add_argument('--profile', type=pathlib.Path, help="print a profile of the build and write its call stacks to a flamegraph compatible file", metavar="stack_file")
+    parser.add_argument('--seed', type=int, help="seed compile time randomness so builds are reproducible")
+    parser.add_argument('--time', type=float, help="freeze @ctime at this unix time in milliseconds, defaults to SOURCE_DATE_EPOCH if set", metavar="ms")
+    parser.add_argument('--max-steps', type=int, help="stop the build after this many compile time instructions", metavar="count")
+    parser.add_argument('--max-depth', type=int, help="limit how deeply macros and imports can nest", metavar="depth")
+    parser.add_argument('--max-time', type=float, help="stop the build after this many seconds", metavar="seconds")
+    parser.add_argument('--max-collection', type=int, help="limit how many items a compile time list or table can hold", metavar="items")
+    parser.add_argument('--compile-lib', nargs='+', type=pathlib.Path, help="precompile libraries into .sfmc bundles that 'import' loads instead of the source", metavar="library")
+    parser.add_argument('--lsp', action='store_true', help="run a language server over stdio for editors")
+    parser.add_argument('--cache', action='store_true', help="reuse the output of a previous build if none of its inputs changed")
+    parser.add_argument('--cache-dir', type=pathlib.Path, default=pathlib.Path.home() / ".cache" / "sfmlog", help="where cached builds are stored", metavar="directory")
+    parser.add_argument('--cache-size', type=int, default=256, help="how many builds the cache keeps before evicting the least recently used", metavar="entries")
+    parser.add_argument('--stats', choices=["text", "json"], help="print timings and counters for each phase of the build")
+    parser.add_argument('--proc-dir', type=pathlib.Path, help="also write each proc's code to its own file in this directory when building a schematic", metavar="directory")
     args = parser.parse_args()
+    if args.lsp:
+        _language_server(sys.stdin.buffer, sys.stdout.buffer).serve()
+        sys.exit(0)
+    if args.compile_lib:
+        for lib in args.compile_lib:
+            print(f"Compiled '{lib}' to '{_bundle.write(lib)}'")
+        if args.src is None:
+            sys.exit(0)
+    elif args.src is None:
+        parser.error("the following arguments are required: -s/--src")
     with open(args.src, 'r') as f:
         code = f.read()
 
     transpiler = SFMlog()
+    profiler = _profiler() if args.profile else None
+    stats = _stats() if args.stats else None
+    context = _BuildContext.from_env(args.seed, args.time, _limits(args.max_steps, args.max_depth, args.max_time, args.max_collection))
+    cache = _OutputCache(args.cache_dir, args.cache_size) if args.cache else None
     start_time = time.perf_counter()
-    out_schem = transpiler.transpile(code, args.src, args.text)
+    if args.text and args.out and not args.copy: # Stream straight into the output file, replacing it only once the build succeeds
+        temp_out = args.out.with_name(f"{args.out.name}.{os.getpid()}.tmp")
+        try:
+            with open(temp_out, "w") as f:
+                out_schem = transpiler.transpile(code, args.src, args.text, profiler, stats, context, cache, stream=f)
+            os.replace(temp_out, args.out)
+        except BaseException:
+            temp_out.unlink(missing_ok=True)
+            raise
+    else:
+        temp_out = None
+        out_schem = transpiler.transpile(code, args.src, args.text, profiler, stats, context, cache, proc_dir=args.proc_dir)
     end_time = time.perf_counter()
+    if profiler is not None:
+        print(profiler.report())
+        profiler.write_collapsed(args.profile)
     if not args.text:
         print(f"Created schematic '{out_schem.tags["name"]}' in {end_time - start_time:0.2f} seconds")
     else:
         print(f"Compiled code in {end_time - start_time:0.2f} seconds")
+    if cache is not None:
+        if args.proc_dir is not None and temp_out is None: # Streamed text builds never get proc_dir, so they still use the cache
+            print("Cache not used, whole-build cache disabled with --proc-dir")
+        else:
+            print(cache.report())
+    if stats is not None:
+        if args.stats == "text":
+            print(stats.report())
+        else: # Build output and status lines share stdout, so json goes to stderr where it can be parsed on its own
+            print(json.dumps(stats.to_dict()), file=sys.stderr)
 
     if args.copy:
         if not args.text:
             out_schem.write_clipboard()
         else:
             pyperclip.copy(out_schem)
-    if args.out:
+    if args.out and temp_out is None:
         if not args.text:
             out_schem.write_file(args.out)
         else:
@@ -0,0 +1,26 @@
+import contextlib, io, pathlib, sys, tempfile, unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from sfmlog import SFMlog, _BuildContext, _OutputCache
+
+class CacheTest(unittest.TestCase):
+    def build_twice(self, code: str, as_text: bool, context: _BuildContext) -> tuple[list, dict]:
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            directory = pathlib.Path(directory)
+            source = directory / "main.sfm"
+            source.write_text(code)
+            cache = _OutputCache(directory / "cache")
+            outputs = [SFMlog().transpile(code, source, as_text, context=context, cache=cache) for _ in range(2)]
+            return outputs, cache.stats
+
+    def test_cached_schematic_matches_build(self):
+        (first, second), stats = self.build_twice("proc\n  print 1\nend\n", False, _BuildContext(0, 0.0))
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(first.write_str(), second.write_str())
+
+    def test_uncacheable_build_is_not_a_miss(self): # Reading the real clock makes a build impossible to reuse
+        _, stats = self.build_twice("set a @ctime\nprint a\n", True, _BuildContext(0))
+        self.assertEqual((stats["hits"], stats["misses"], stats["skipped"]), (0, 0, 2))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import contextlib, io, pathlib, sys, tempfile, unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from sfmlog import SFMlog, _BuildContext, _CompileError, _limits
+
+GUARDED_RECURSION = """defmac R n
+  pop add n n 1
+  if lessThan n 150
+    mac R n
+  end
+end
+mac R 0
+print 1
+"""
+
+class LimitsTest(unittest.TestCase):
+    def build_text(self, code: str, limits: _limits | None = None) -> str:
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            source = pathlib.Path(directory) / "main.sfm"
+            source.write_text(code)
+            return SFMlog().transpile(code, source, True, context=_BuildContext(limits=limits))
+
+    def test_guarded_recursion_compiles_without_limits(self): # Only macro and import nesting counts, so this has to fit Python's own stack
+        self.assertEqual(self.build_text(GUARDED_RECURSION).strip(), "print 1")
+
+    def test_depth_limit_stops_nesting(self):
+        with self.assertRaises(_CompileError):
+            self.build_text(GUARDED_RECURSION, _limits(max_depth=20))
+
+    def test_unguarded_recursion_is_a_compile_error(self): # Running out of Python stack is reported like any other error
+        with self.assertRaises(_CompileError):
+            self.build_text("defmac R\n  mac R\nend\nmac R\n")
+
+if __name__ == "__main__":
+    unittest.main()
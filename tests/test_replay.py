@@ -0,0 +1,93 @@
+import pathlib, sys, tempfile, unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from sfmlog import SFMlog
+
+# A memoized body recorded in a proc that already called G must still bring G's body into a proc that didn't
+
+FUNCTION_REPLAY = """deffun G
+  print 1
+end
+deffun F
+  fun G
+end
+proc
+  fun G
+  fun F
+end
+proc
+  fun F
+end
+"""
+
+PURE_MACRO_REPLAY = """deffun G
+  print 1
+end
+defpure M
+  fun G
+end
+proc
+  fun G
+  mac M
+end
+proc
+  mac M
+end
+"""
+
+IMPORT_MUTATED = """import "reg.sfmlib"
+list append $REG 1
+table set $TBL 1 "k"
+import "reg.sfmlib"
+list len a $REG
+table len b $TBL
+print a b
+"""
+
+PURE_MACRO_MUTATED = """defpure Init
+  list from $REG
+end
+mac Init
+list append $REG 1
+mac Init
+list len a $REG
+print a
+"""
+
+class ReplayTest(unittest.TestCase):
+    def build_text(self, code: str, files: dict[str, str] | None = None) -> str:
+        with tempfile.TemporaryDirectory() as directory:
+            directory = pathlib.Path(directory)
+            for name, text in (files or {}).items():
+                (directory / name).write_text(text)
+            source = directory / "main.sfm"
+            source.write_text(code)
+            return SFMlog().transpile(code, source, True)
+
+    def build_procs(self, code: str) -> list[str]:
+        with tempfile.TemporaryDirectory() as directory:
+            directory = pathlib.Path(directory)
+            source = directory / "main.sfm"
+            source.write_text(code)
+            SFMlog().transpile(code, source, False, proc_dir=directory / "procs")
+            return [(directory / "procs" / f"processor{index}.mlog").read_text() for index in (1, 2)]
+
+    def test_function_replay_keeps_callees(self):
+        second = self.build_procs(FUNCTION_REPLAY)[1]
+        self.assertIn("jump function_G always", second)
+        self.assertIn("function_G:", second)
+
+    def test_pure_macro_replay_keeps_callees(self):
+        second = self.build_procs(PURE_MACRO_REPLAY)[1]
+        self.assertIn("jump function_G always", second)
+        self.assertIn("end\nfunction_G:", second)
+
+    def test_import_replay_ignores_later_mutation(self): # A replayed import has to match running the file again
+        out = self.build_text(IMPORT_MUTATED, {"reg.sfmlib": "list from $REG\ntable from $TBL\n"})
+        self.assertEqual(out.strip(), "print 0 0")
+
+    def test_pure_macro_replay_ignores_later_mutation(self): # A replayed pure macro has to match a fresh expansion
+        self.assertEqual(self.build_text(PURE_MACRO_MUTATED).strip(), "print 0")
+
+if __name__ == "__main__":
+    unittest.main()